@@ -14,6 +14,9 @@ import synthvoice.percussive
 
 import hardware
 import menu
+import midi
+from clock import Clock
+import telemetry
 
 hardware.init()
 
@@ -76,8 +79,7 @@ def sequencer_press(notenum:int, velocity:float) -> None:
     voices[(notenum - 1) % len(voices)].press(velocity)
 
     msg = NoteOn(notenum)
-    hardware.midi_uart.send(msg)
-    hardware.midi_usb.send(msg)
+    midi.send(msg)
 sequencer.on_press = sequencer_press
 
 def sequencer_release(notenum):
@@ -87,10 +89,15 @@ def sequencer_release(notenum):
 
     # Send midi note off
     msg = NoteOff(notenum)
-    hardware.midi_uart.send(msg)
-    hardware.midi_usb.send(msg)
+    midi.send(msg)
 sequencer.on_release = sequencer_release
 
+## USB & Hardware MIDI
+
+router = midi.Router()
+clock = Clock(sequencer, transport=True)
+clock.attach(router)
+
 def update_display():
     hardware.lcd.cursor_position(0, 0)
     hardware.lcd.message = "{:<11s}{:s} {:>3d}".format(
@@ -216,6 +223,9 @@ async def main():
         asyncio.create_task(sequencer.update()),
         asyncio.create_task(touch_task()),
         asyncio.create_task(update_controls()),
+        asyncio.create_task(router.update()),
+        asyncio.create_task(midi.update()),
+        asyncio.create_task(telemetry.update()),
     )
 
 asyncio.run(main())
@@ -21,14 +21,28 @@ import umidiparser
 import audiocore
 import time
 
+try:
+    import ulab.numpy as np
+except ImportError:
+    import numpy as np
+
 import hardware
 import menu
+import midi
+import settings
+import telemetry
+import wav
+import codec
 import os
 
 # Larger buffer needed to prevent stutters in audio when reading from SD
 hardware.BUFFER_SIZE = 32768
 hardware.TASK_SLEEP = 0.1 #?
 
+STREAM_BLOCKS = codec.BLOCKS # ADPCM blocks decoded into each half of the double buffer per refill
+STREAM_BUFFER = 4096 # Mixer buffer size of ADPCM streams, which read from memory rather than SD (bytes)
+STREAM_SLEEP = 0.01
+
 hardware.init()
 
 DIR = "/sd/songs"
@@ -58,12 +72,84 @@ if not songs:
 
 ## Playback Controller
 
+class Stream:
+    """IMA ADPCM WAV file decoded block by block into a double buffer. The mixer loops over both
+    halves of the buffer continuously while each half is refilled from SD once playback has moved into
+    the other half. Each half holds the group of blocks decoded by a single refill, which is limited so
+    that the whole buffer is no larger than the mixer buffer used for PCM files. The play position is
+    estimated from the time since playback started, as the mixer doesn't expose its position.
+    """
+
+    def __init__(self, path:str, blocks:int = STREAM_BLOCKS):
+        self._file = open(path, "rb")
+        try:
+            fmt, self.channel_count, self.sample_rate, bits, self._block_align, self._offset, length = wav.read_header(self._file)
+            if fmt != wav.FORMAT_IMA_ADPCM or bits != 4:
+                raise ValueError("Unsupported WAV format")
+        except Exception:
+            self._file.close()
+            raise
+        self.bits_per_sample = 16
+        self._block_frames = codec.get_block_samples(self._block_align, self.channel_count)
+        self._blocks = max(min(blocks, hardware.BUFFER_SIZE // (2 * self.channel_count * self.bits_per_sample // 8 * self._block_frames)), 1) # Blocks per half
+        self._half = self._blocks * self._block_frames
+        self._length = length // self._block_align * self._block_frames
+        self._guard = STREAM_BUFFER // (self.channel_count * self.bits_per_sample // 8) # Frames which the mixer may have read ahead
+        self._buffer = bytearray(self._blocks * self._block_align)
+        self._ring = np.zeros(self._half * 2 * self.channel_count, dtype=np.int16)
+        self.sample = audiocore.RawSample(self._ring, channel_count=self.channel_count, sample_rate=self.sample_rate)
+        self.active = False
+        self.underruns = 0
+        self.rewind()
+
+    def rewind(self) -> None:
+        self._file.seek(self._offset)
+        self._filled = 0 # Frames written to the ring
+        self._start = None
+        self._fill()
+        self._fill()
+
+    def start(self) -> None:
+        self._start = time.monotonic_ns()
+        self.active = True
+
+    def _fill(self) -> None:
+        start = (self._filled // self._half) % 2 * self._half * self.channel_count
+        size = self._file.readinto(self._buffer)
+        if size < len(self._buffer):
+            self._ring[start:start + self._half * self.channel_count] = 0
+        if size >= self._block_align:
+            for channel in range(self.channel_count):
+                data = codec.decode_adpcm(memoryview(self._buffer)[:size], self._block_align, self.channel_count, channel)
+                self._ring[start + channel:start + len(data) * self.channel_count:self.channel_count] = data
+        self._filled += self._half
+
+    def update(self) -> bool:
+        """Refill the half of the buffer which has finished playing. Returns `False` once the end of
+        the file has played.
+        """
+        position = (time.monotonic_ns() - self._start) * self.sample_rate // 1000000000
+        if position >= self._length:
+            self.active = False
+            return False
+        if position + self._guard >= self._filled:
+            self.underruns += 1
+            print("player: underrun position={:d} underruns={:d}".format(position, self.underruns))
+        while self._filled - position <= self._half:
+            self._fill()
+        return True
+
+    def close(self) -> None:
+        self.active = False
+        self._file.close()
+
 class Player():
     def __init__(self):
         self._midi_file = None
         self._midi_track = None
         self._audio_file = None
         self._wave = None
+        self._stream = None
         self._mixer = None
         self._level = 1.0
         self._start_time = None
@@ -86,6 +172,10 @@ class Player():
             self._audio_file.close()
             self._audio_file = None
 
+        if self._stream:
+            self._stream.close()
+            self._stream = None
+
         if self._mixer:
             self._mixer.deinit()
             self._mixer = None
@@ -106,14 +196,19 @@ class Player():
         except OSError:
             audio_path = None
         else:
-            self._audio_file = open(audio_path, "rb")
-            self._wave = audiocore.WaveFile(self._audio_file)
+            # ADPCM files are decoded by the player as WaveFile only supports PCM
+            try:
+                self._stream = Stream(audio_path)
+            except ValueError:
+                self._audio_file = open(audio_path, "rb")
+                self._wave = audiocore.WaveFile(self._audio_file)
+            source = self._stream if self._stream else self._wave
             self._mixer = audiomixer.Mixer(
                 voice_count=1,
-                channel_count=self._wave.channel_count,
-                sample_rate=self._wave.sample_rate,
-                buffer_size=hardware.BUFFER_SIZE,
-                bits_per_sample=self._wave.bits_per_sample,
+                channel_count=source.channel_count,
+                sample_rate=source.sample_rate,
+                buffer_size=STREAM_BUFFER if self._stream else hardware.BUFFER_SIZE,
+                bits_per_sample=source.bits_per_sample,
                 samples_signed=True,
             )
             hardware.audio.play(self._mixer)
@@ -122,6 +217,10 @@ class Player():
     def play(self) -> None:
         if self._mixer and self._wave:
             self._mixer.play(self._wave)
+        elif self._mixer and self._stream:
+            self._stream.rewind()
+            self._mixer.play(self._stream.sample, loop=True)
+            self._stream.start()
 
         if self._midi_file:
             self._midi_track = self._midi_file.play(sleep=False)
@@ -132,6 +231,8 @@ class Player():
     def stop(self) -> None:
         if self._mixer:
             self._mixer.stop_voice()
+        if self._stream:
+            self._stream.active = False
         self._midi_playing = False
         self._start_time = None
 
@@ -153,7 +254,7 @@ class Player():
 
     @property
     def audio_playing(self) -> bool:
-        return self._mixer and self._mixer.playing
+        return (self._mixer and self._mixer.playing) or (self._stream and self._stream.active)
     
     @property
     def midi_playing(self) -> bool:
@@ -164,8 +265,9 @@ class Player():
         return self.audio_playing or self.midi_playing
 
     def _send(self, msg:MIDIMessage) -> None:
-        hardware.midi_usb.send(msg)
-        hardware.midi_uart.send(msg)
+        # Sent right away rather than waiting for the output task, which only runs every TASK_SLEEP
+        midi.send(msg)
+        midi.flush()
         
     async def update(self) -> None:
         while True:
@@ -201,11 +303,19 @@ class Player():
 
             await asyncio.sleep(hardware.TASK_SLEEP)
 
+    async def stream_update(self) -> None:
+        # Polled more often than other tasks so that each half is refilled well before it's needed
+        while True:
+            if self._stream and self._stream.active and not self._stream.update():
+                if self._mixer:
+                    self._mixer.stop_voice()
+            await asyncio.sleep(STREAM_SLEEP)
+
 player = Player()
 
 ## Character LCD Menu
 
-lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware.ROWS, "Menu", (
+lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware.ROWS, "Menu", tuple([
     synthmenu.Percentage(
         title="Volume",
         default=1.0,
@@ -217,8 +327,9 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
         on_update=lambda value, item: player.load(value),
     ),
     synthmenu.Action(lambda item: "Stop" if player.playing else "Play", player.toggle),
-    synthmenu.Action("Exit", menu.load_launcher)
-))
+] + ([telemetry.group()] if settings.performance_telemetry else []) + [
+    synthmenu.Action("Exit", menu.load_launcher),
+]))
 
 # Load first song
 player.load(0)
@@ -235,7 +346,10 @@ async def controls_task():
 async def main():
     await asyncio.gather(
         asyncio.create_task(player.update()),
+        asyncio.create_task(player.stream_update()),
         asyncio.create_task(controls_task()),
+        asyncio.create_task(midi.update()),
+        asyncio.create_task(telemetry.update()),
     )
 
 asyncio.run(main())
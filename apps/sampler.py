@@ -2,7 +2,6 @@
 #
 # SPDX-License-Identifier: Unlicense
 
-import synthwaveform
 import synthvoice.sample
 import synthkeyboard
 
@@ -11,12 +10,8 @@ import synthio
 
 import synthmenu.character_lcd
 
-import adafruit_midi
 from adafruit_midi.note_on import NoteOn
 from adafruit_midi.note_off import NoteOff
-from adafruit_midi.control_change import ControlChange
-from adafruit_midi.pitch_bend import PitchBend
-from adafruit_midi.midi_message import MIDIMessage, MIDIUnknownEvent
 
 import asyncio
 import time
@@ -27,10 +22,25 @@ import gc
 import hardware
 import menu
 import settings
+import midi
+from clock import Clock
+from controls import ControlMap
+import telemetry
+from governor import Governor
+from samples import Cache
+from stream import Streamer, Sample
+import pitch
+import preprocess
+import wav
+from keymap import Keymap, Zone
+import bank
 
 hardware.init()
 
 VOICES = 12 if board.board_id == "raspberry_pi_pico2" else 6
+CACHE = 256 * 1024 if board.board_id == "raspberry_pi_pico2" else 64 * 1024 # Maximum decoded sample arena (bytes)
+ARENA = 0.5 # Maximum ratio of free memory reserved for the sample arena
+STREAM = 0.5 # Maximum ratio of free memory after the arena reserved for stream rings
 
 DIR = "/sd/samples"
 try:
@@ -38,6 +48,10 @@ try:
 except OSError:
     DIR = "/samples"
 
+# Reserve sample memory while the heap is least fragmented
+gc.collect()
+cache = Cache(min(CACHE, int(gc.mem_free() * ARENA)))
+
 ## Audio Output + Synthesizer
 
 mixer = audiomixer.Mixer(
@@ -71,11 +85,22 @@ keyboard = synthkeyboard.Keyboard(
     root=48,
 )
 
+# Reduce polyphony when processing headroom runs out
+governor = Governor(keyboard, VOICES)
+
+def set_monophonic(value:bool, item:synthmenu.Item = None) -> None:
+    governor.active = not value
+    keyboard.max_voices = 1 if value else governor.voices
+
 def voice_press(voice:synthvoice.Voice) -> None:
+    if sample_map is not None and not set_zone(voice.index, sample_map.get(voice.note.notenum, voice.note.velocity)):
+        return
+    streamer.press(voice.index)
     voices[voice.index].press(
         notenum=voice.note.notenum,
         velocity=voice.note.velocity,
     )
+    midi.record_press()
     hardware.led.value = True
 keyboard.on_voice_press = voice_press
 
@@ -91,48 +116,10 @@ keyboard.arpeggiator = synthkeyboard.Arpeggiator(
 
 ## USB & Hardware MIDI
 
-def midi_process_message(msg:MIDIMessage) -> None:
-    if settings.midi_thru and not isinstance(msg, MIDIUnknownEvent):
-        hardware.midi_usb.send(msg)
-        hardware.midi_uart.send(msg)
-
-    if settings.midi_channel is not None and msg.channel != settings.midi_channel:
-        return
-    
-    if isinstance(msg, NoteOn):
-        if msg.velocity > 0.0:
-            keyboard.append(msg.note, msg.velocity)
-        else:
-            keyboard.remove(msg.note)
-
-    elif isinstance(msg, NoteOff):
-        keyboard.remove(msg.note)
-
-    elif isinstance(msg, ControlChange):
-        if msg.control == 7: # Volume
-            mixer.voice[0].level = msg.value / 127
-        elif msg.control == 10: # Pan
-            menu.set_attribute(voices, 'pan', msg.value / 64 - 1)
-        elif msg.control == 11: # Expression
-            menu.set_attribute(voices, 'velocity_amount', msg.value / 127)
-        elif msg.control == 64: # Sustain
-            keyboard.sustain = msg.value >= 64
-
-    elif isinstance(msg, PitchBend):
-        menu.set_attribute(voices, 'bend', (msg.pitch_bend - 8192) / 8192)
-    
-def midi_process_messages(midi:adafruit_midi.MIDI, limit:int = 32) -> None:
-    while limit:
-        if not (msg := midi.receive()):
-            break
-        midi_process_message(msg)
-        limit -= 1
-
-async def midi_task() -> None:
-    while True:
-        midi_process_messages(hardware.midi_usb)
-        midi_process_messages(hardware.midi_uart)
-        await asyncio.sleep(hardware.TASK_SLEEP)
+router = midi.get_router(keyboard, mixer, voices)
+clock = Clock(keyboard.arpeggiator)
+clock.attach(router)
+control_map = ControlMap(router, 'sampler')
 
 ## Touch Keyboard Interface
 
@@ -142,8 +129,7 @@ def ttp_press(i:int) -> None:
         keyboard.append(notenum)
     if settings.midi_touch_out:
         msg = NoteOn(notenum)
-        hardware.midi_uart.send(msg)
-        hardware.midi_usb.send(msg)
+        midi.send(msg)
 hardware.ttp.on_press = ttp_press
 
 def ttp_release(i:int) -> None:
@@ -152,8 +138,7 @@ def ttp_release(i:int) -> None:
         keyboard.remove(notenum)
     if settings.midi_touch_out:
         msg = NoteOff(notenum)
-        hardware.midi_uart.send(msg)
-        hardware.midi_usb.send(msg)
+        midi.send(msg)
 hardware.ttp.on_release = ttp_release
 
 async def touch_task() -> None:
@@ -163,22 +148,212 @@ async def touch_task() -> None:
 
 ## Character LCD Menu
 
-sample_files = list(filter(lambda filename: filename.endswith(".wav"), os.listdir(DIR)))
+# Read all patches into memory to avoid storage access when switching
+menu.load_patches('sampler')
+
+def load_patch(value:int, item:synthmenu.Item) -> None:
+    menu.load_patch(lcd_menu, item, value, 'sampler')
+    control_map.load(value)
+
+def save_patch() -> None:
+    if menu.save_patch(lcd_menu, patch.value, 'sampler'):
+        control_map.save(patch.value)
+
+# Samples within banks are listed from the bank header alone
+sample_files = []
+for filename in os.listdir(DIR):
+    if filename.endswith(".wav") or filename.endswith(".map"):
+        sample_files.append(filename)
+    elif filename.endswith(".bank"):
+        try:
+            sample_files.extend([filename + bank.SEPARATOR + entry.name for entry in bank.load(DIR + "/" + filename).entries])
+        except (OSError, ValueError):
+            print("sampler: invalid bank path={:s}".format(filename))
 if not sample_files:
     menu.write_message("No samples!", True)
     menu.load_launcher()
 
+# Reserve stream rings up front from what the arena left so that streaming can't exhaust the heap
+gc.collect()
+streamer = Streamer(synth, voices)
+if not streamer.reserve(int(gc.mem_free() * STREAM)):
+    print("sampler: streaming unavailable")
+streamer.on_underrun = lambda index: voices[index].release()
+
+# Path of the cached sample assigned to each voice
+voice_paths = [None] * VOICES
+
+def set_voice_path(index:int, path:str|None) -> None:
+    voice_paths[index] = path
+    if path is None:
+        voices[index].waveform = None
+
+def update_waveforms() -> None:
+    # Cached waveforms are replaced when the arena is compacted
+    for i, path in enumerate(voice_paths):
+        if path is not None and (waveform := cache.find(path)) is not None:
+            voices[i].waveform = waveform
+cache.on_compact = update_waveforms
+
+def get_name(filename:str) -> str:
+    if bank.is_entry(filename):
+        return menu.format_name(bank.split(filename)[1])
+    return menu.format_name(filename[:-4])
+
+def is_streamed(path:str) -> bool:
+    # Samples with files larger than half of the arena are streamed from storage
+    return not bank.is_entry(path) and os.stat(path)[6] > cache.budget // 2
+
+def get_sample(path:str) -> tuple:
+    # Avoid evicting samples which voices are currently playing
+    try:
+        return cache.get(path, tuple(voice_paths))
+    except (MemoryError, ValueError, OSError) as error:
+        print("sampler: load failed path={:s} error={:s}".format(path, str(error)))
+        return None, None
+
+def read_waveform(path:str) -> object:
+    if path.endswith(".map"):
+        zone = (sample_map if sample_map is not None and sample_map.path == path else Keymap(path, DIR)).get(keyboard.root + 12)
+        return get_sample(zone.path)[0] if zone is not None else None
+    # Only the attack of streamed samples is available in memory
+    if not is_streamed(path):
+        return get_sample(path)[0]
+    elif streamer.sample is not None and streamer.sample.path == path:
+        return streamer.sample.attack
+    try:
+        return Sample(path, streamer.size).attack
+    except (ValueError, MemoryError):
+        return None
+
+# Tuning of each sample is only detected when the file is new or has changed
+pitch_index = pitch.Index(DIR)
+
+def get_tuning(path:str, waveform:object, sample_rate:int) -> tuple:
+    # Bank samples are tuned when packed
+    if bank.is_entry(path):
+        entry = bank.get(path)[1]
+        return entry.root, entry.tune
+    entry = pitch_index.get(path, waveform, sample_rate)
+    return entry["root"], entry["tune"]
+
+def set_tuning(path:str, waveform:object, sample_rate:int) -> None:
+    menu.set_attribute(voices, 'root', pitch.to_frequency(*get_tuning(path, waveform, sample_rate)))
+
+# Multisample zones are assigned to each voice as it is pressed
+sample_map = None
+
+def set_zone(index:int, zone:Zone|None) -> bool:
+    """Assign the sample of a zone to a voice. Returns `False` if the zone has no sample which can be
+    played.
+    """
+    if zone is None:
+        return False
+    if voice_paths[index] == zone.path:
+        return True
+    set_voice_path(index, None)
+    waveform, sample_rate = get_sample(zone.path)
+    if waveform is None:
+        return False
+    voice = voices[index]
+    set_voice_path(index, zone.path)
+    voice.waveform = waveform
+    voice.sample_rate = sample_rate
+    if zone.root is None:
+        zone.root, zone.tune = get_tuning(zone.path, waveform, sample_rate)
+    voice.root = pitch.to_frequency(zone.root, zone.tune)
+    return True
+
+sample_index = 0
+
 def load_sample(index:int) -> None:
-    for voice in voices:
-        voice.waveform = None
-    gc.collect()
+    global sample_index, sample_map
+    sample_index = index
+    sample_map = None
     path = DIR + "/" + sample_files[index % len(sample_files)]
-    waveform, sample_rate = synthwaveform.from_wav(path)
-    for voice in voices:
+    for i in range(len(voices)):
+        set_voice_path(i, None)
+    if path.endswith(".map"):
+        if streamer.sample is not None:
+            streamer.unload()
+            menu.set_attribute(voices, 'looping', streamer.looping)
+        sample_map = Keymap(path, DIR)
+        return
+    if is_streamed(path):
+        # Only PCM samples can be streamed
+        try:
+            sample = streamer.load(path)
+        except ValueError:
+            streamer.unload()
+            menu.write_message("Unsupported!", True)
+            return
+        except MemoryError:
+            streamer.unload()
+            menu.write_message("Too large!", True)
+            return
+        set_tuning(path, sample.attack, sample.sample_rate)
+        return
+    if streamer.sample is not None:
+        streamer.unload()
+        menu.set_attribute(voices, 'looping', streamer.looping)
+    waveform, sample_rate = get_sample(path)
+    if waveform is None:
+        menu.write_message("Too large!", True)
+        return
+    for i, voice in enumerate(voices):
+        set_voice_path(i, path)
         voice.waveform = waveform
         voice.sample_rate = sample_rate
-
-lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware.ROWS, "Menu", (
+    set_tuning(path, waveform, sample_rate)
+    if (loop := read_loop(path)) is not None:
+        set_waveform_loop(loop[0] / len(waveform), loop[1] / len(waveform))
+
+def read_loop(path:str) -> tuple|None:
+    # Loop points are stored in the bank index or in the smpl chunk written by optimize_sample
+    if bank.is_entry(path):
+        return bank.get(path)[1].loop
+    try:
+        with open(path, "rb") as file:
+            return wav.read_sampler(file)[1]
+    except OSError:
+        return None
+
+def set_waveform_loop(start:float|None, end:float|None) -> None:
+    # Streamed voices always loop their entire ring buffer
+    if streamer.sample is None:
+        menu.set_attribute(voices, 'waveform_loop', (
+            voices[0].waveform_loop[0] if start is None else start,
+            voices[0].waveform_loop[1] if end is None else end,
+        ))
+
+def set_looping(value:bool, item:synthmenu.Item = None) -> None:
+    streamer.looping = value
+    if streamer.sample is None:
+        menu.set_attribute(voices, 'looping', value)
+
+def optimize_sample() -> None:
+    # Resample, normalize and trim the current sample in place and find its loop points
+    path = DIR + "/" + sample_files[sample_index % len(sample_files)]
+    if not path.endswith(".wav"):
+        menu.write_message("Unsupported!", True)
+        return
+    if is_streamed(path):
+        menu.write_message("Too large!", True)
+        return
+    menu.write_message("Processing...")
+    for i in range(len(voices)):
+        set_voice_path(i, None)
+    cache.remove(path)
+    gc.collect()
+    try:
+        preprocess.process(path, sample_rate=hardware.SAMPLE_RATE)
+    except (OSError, ValueError, MemoryError):
+        menu.write_message("Failed!", True)
+    else:
+        menu.write_message("Complete!", True)
+    load_sample(sample_index)
+
+lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware.ROWS, "Menu", tuple([
     synthmenu.Group("Patch", (
         patch := synthmenu.Number(
             title="Index",
@@ -188,10 +363,10 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
             maximum=15,
             loop=True,
             decimals=0,
-            on_update=lambda value, item: menu.load_patch(lcd_menu, item, value, 'sampler'),
+            on_update=load_patch,
         ),
         synthmenu.String("Name"),
-        synthmenu.Action("Save", lambda: menu.save_patch(lcd_menu, patch.value, 'sampler')),
+        synthmenu.Action("Save", save_patch),
     )),
     synthmenu.Group("Audio", (
         synthmenu.Percentage(
@@ -208,7 +383,7 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
         ),
         synthmenu.Bool(
             title="Monophonic",
-            on_update=lambda value, item: menu.set_attribute(keyboard, 'max_voices', 1 if value else VOICES),
+            on_update=set_monophonic,
         ),
         menu.get_arpeggiator_group(keyboard.arpeggiator),
     )),
@@ -216,18 +391,19 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
         synthmenu.Waveform(
             title="Sample",
             items=tuple([
-                (menu.format_name(filename[:-4]), lambda filename=filename: synthwaveform.from_wav(DIR + "/" + filename)[0])
+                (get_name(filename), lambda filename=filename: read_waveform(DIR + "/" + filename))
                 for filename in sample_files
             ]),
             on_waveform_update=lambda value, item: load_sample(value),
-            on_loop_start_update=lambda value, item: menu.set_attribute(voices, 'waveform_loop', (value, voices[0].waveform_loop[1])),
-            on_loop_end_update=lambda value, item: menu.set_attribute(voices, 'waveform_loop', (voices[0].waveform_loop[0], value)),
+            on_loop_start_update=lambda value, item: set_waveform_loop(value, None),
+            on_loop_end_update=lambda value, item: set_waveform_loop(None, value),
         ),
         synthmenu.Bool(
             title="Looping",
             default=True,
-            on_update=lambda value, item: menu.set_attribute(voices, 'looping', value),
+            on_update=set_looping,
         ),
+        synthmenu.Action("Optimize", optimize_sample),
         synthmenu.Mix(
             title="Mix",
             on_level_update=lambda value, item: menu.set_attribute(voices, 'amplitude', value),
@@ -401,8 +577,11 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
             )),
         )),
     )),
+] + [control_map.group()] + ([telemetry.group()] if settings.performance_telemetry else []) + [
     synthmenu.Action("Exit", menu.load_launcher),
-))
+]))
+
+control_map.attach(lcd_menu)
 
 # Perform a full update which will synchronize oscillator properties
 
@@ -421,9 +600,13 @@ async def main():
     await asyncio.gather(
         asyncio.create_task(keyboard.arpeggiator.update()),
         asyncio.create_task(voice_task()),
+        asyncio.create_task(streamer.update()),
         asyncio.create_task(touch_task()),
-        asyncio.create_task(midi_task()),
+        asyncio.create_task(router.update()),
         asyncio.create_task(controls_task()),
+        asyncio.create_task(governor.update()),
+        asyncio.create_task(midi.update()),
+        asyncio.create_task(telemetry.update()),
     )
 
 asyncio.run(main())
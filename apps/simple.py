@@ -13,12 +13,8 @@ import synthio
 
 import synthmenu.character_lcd
 
-import adafruit_midi
 from adafruit_midi.note_on import NoteOn
 from adafruit_midi.note_off import NoteOff
-from adafruit_midi.control_change import ControlChange
-from adafruit_midi.pitch_bend import PitchBend
-from adafruit_midi.midi_message import MIDIMessage, MIDIUnknownEvent
 
 import asyncio
 import board
@@ -26,6 +22,10 @@ import board
 import hardware
 import menu
 import settings
+import midi
+import telemetry
+import effects
+from governor import Governor
 
 hardware.init()
 
@@ -70,7 +70,6 @@ if EFFECTS:
     )
 
     chorus_lfo = synthio.LFO(scale=0.0, offset=0.0, rate=1.0)
-    synth.blocks.append(chorus_lfo)
     def set_chorus_depth(value:float) -> None:
         chorus_lfo.scale = CHORUS_DELAY * value / 2
         chorus_lfo.offset = CHORUS_DELAY * (1 - value / 2)
@@ -86,9 +85,10 @@ if EFFECTS:
         sample_rate=hardware.SAMPLE_RATE,
     )
 
-    chorus.play(synth)
-    delay.play(chorus)
-    mixer.voice[0].play(delay)
+    chain = effects.Chain(synth, mixer.voice[0])
+    chain.append("Chorus", chorus, (chorus_lfo,))
+    chain.append("Delay", delay)
+    chain.update()
 
 else:
     mixer.voice[0].play(synth)
@@ -121,11 +121,15 @@ keyboard = synthkeyboard.Keyboard(
     root=48,
 )
 
+# Reduce polyphony when processing headroom runs out
+governor = Governor(keyboard, VOICES)
+
 def voice_press(voice:synthvoice.Voice) -> None:
     voices[voice.index].press(
         notenum=voice.note.notenum,
         velocity=voice.note.velocity,
     )
+    midi.record_press()
     hardware.led.value = True
 keyboard.on_voice_press = voice_press
 
@@ -137,48 +141,7 @@ keyboard.on_voice_release = voice_release
 
 ## USB & Hardware MIDI
 
-def midi_process_message(msg:MIDIMessage) -> None:
-    if settings.midi_thru and not isinstance(msg, MIDIUnknownEvent):
-        hardware.midi_usb.send(msg)
-        hardware.midi_uart.send(msg)
-
-    if settings.midi_channel is not None and msg.channel != settings.midi_channel:
-        return
-    
-    if isinstance(msg, NoteOn):
-        if msg.velocity > 0.0:
-            keyboard.append(msg.note, msg.velocity)
-        else:
-            keyboard.remove(msg.note)
-
-    elif isinstance(msg, NoteOff):
-        keyboard.remove(msg.note)
-
-    elif isinstance(msg, ControlChange):
-        if msg.control == 7: # Volume
-            mixer.voice[0].level = msg.value / 127
-        elif msg.control == 10: # Pan
-            menu.set_attribute(voices, 'pan', msg.value / 64 - 1)
-        elif msg.control == 11: # Expression
-            menu.set_attribute(voices, 'velocity_amount', msg.value / 127)
-        elif msg.control == 64: # Sustain
-            keyboard.sustain = msg.value >= 64
-
-    elif isinstance(msg, PitchBend):
-        menu.set_attribute(voices, 'bend', (msg.pitch_bend - 8192) / 8192)
-    
-def midi_process_messages(midi:adafruit_midi.MIDI, limit:int = 32) -> None:
-    while limit:
-        if not (msg := midi.receive()):
-            break
-        midi_process_message(msg)
-        limit -= 1
-
-async def midi_task() -> None:
-    while True:
-        midi_process_messages(hardware.midi_usb)
-        midi_process_messages(hardware.midi_uart)
-        await asyncio.sleep(hardware.TASK_SLEEP)
+router = midi.get_router(keyboard, mixer, voices)
 
 ## Touch Keyboard Interface
 
@@ -188,8 +151,7 @@ def ttp_press(i:int) -> None:
         keyboard.append(notenum)
     if settings.midi_touch_out:
         msg = NoteOn(notenum)
-        hardware.midi_uart.send(msg)
-        hardware.midi_usb.send(msg)
+        midi.send(msg)
 hardware.ttp.on_press = ttp_press
 
 def ttp_release(i:int) -> None:
@@ -198,8 +160,7 @@ def ttp_release(i:int) -> None:
         keyboard.remove(notenum)
     if settings.midi_touch_out:
         msg = NoteOff(notenum)
-        hardware.midi_uart.send(msg)
-        hardware.midi_usb.send(msg)
+        midi.send(msg)
 hardware.ttp.on_release = ttp_release
 
 async def touch_task() -> None:
@@ -209,14 +170,15 @@ async def touch_task() -> None:
 
 ## Character LCD Menu
 
-lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware.ROWS, "Menu", (
+lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware.ROWS, "Menu", tuple([
     synthmenu.Percentage(
         title="Volume",
         default=1.0,
         on_update=lambda value, item: menu.set_attribute(mixer.voice, 'level', value),
     ),
-    synthmenu.Action("Exit", menu.load_launcher)
-))
+] + ([telemetry.group()] if settings.performance_telemetry else []) + [
+    synthmenu.Action("Exit", menu.load_launcher),
+]))
 
 ## Controls
 
@@ -231,8 +193,12 @@ async def main():
     await asyncio.gather(
         asyncio.create_task(synth_task()),
         asyncio.create_task(touch_task()),
-        asyncio.create_task(midi_task()),
+        asyncio.create_task(router.update()),
         asyncio.create_task(controls_task()),
+        asyncio.create_task(governor.update()),
+        asyncio.create_task(midi.update()),
+        asyncio.create_task(telemetry.update()),
+        *([asyncio.create_task(chain.task())] if EFFECTS else []),
     )
 
 asyncio.run(main())
@@ -11,12 +11,8 @@ import synthio
 
 import synthmenu.character_lcd
 
-import adafruit_midi
 from adafruit_midi.note_on import NoteOn
 from adafruit_midi.note_off import NoteOff
-from adafruit_midi.control_change import ControlChange
-from adafruit_midi.pitch_bend import PitchBend
-from adafruit_midi.midi_message import MIDIMessage, MIDIUnknownEvent
 
 from micropython import const
 
@@ -26,6 +22,14 @@ import board
 import hardware
 import menu
 import settings
+import midi
+from clock import Clock
+from controls import ControlMap
+import telemetry
+import wavetable
+import lfo
+import effects
+from governor import Governor
 
 hardware.init()
 
@@ -69,7 +73,6 @@ if EFFECTS:
     )
 
     chorus_lfo = synthio.LFO(scale=0.0, offset=0.0, rate=1.0)
-    synth.blocks.append(chorus_lfo)
     def set_chorus_depth(value:float, item:synthmenu.Item = None) -> None:
         chorus_lfo.scale = CHORUS_DELAY * value / 2
         chorus_lfo.offset = CHORUS_DELAY * (1 - value / 2)
@@ -84,21 +87,70 @@ if EFFECTS:
         sample_rate=hardware.SAMPLE_RATE,
     )
 
-    chorus.play(synth)
-    delay.play(chorus)
-    mixer.voice[0].play(delay)
+    # Stages with no mix are bypassed until their mix is raised
+    chain = effects.Chain(synth, mixer.voice[0])
+    chain.append("Chorus", chorus, (chorus_lfo,))
+    chain.append("Delay", delay)
+    chain.update()
 
 else:
     mixer.voice[0].play(synth)
 
 oscillators = [synthvoice.oscillator.Oscillator(synth) for i in range(VOICES * OSCILLATORS)]
 
+## Waveforms
+
+waveforms = (
+    ("Sine", synthwaveform.sine, None),
+    ("Saw", lambda: wavetable.get(wavetable.Shape.SAW, hardware.SAMPLE_RATE).get(0), wavetable.Shape.SAW),
+    ("Triangle", lambda: wavetable.get(wavetable.Shape.TRIANGLE, hardware.SAMPLE_RATE).get(0), wavetable.Shape.TRIANGLE),
+    ("Square", lambda: wavetable.get(wavetable.Shape.SQUARE, hardware.SAMPLE_RATE).get(0), wavetable.Shape.SQUARE),
+    ("Noise", synthwaveform.noise, None),
+)
+
+# Band-limited wavetable set of each oscillator group, the table for the octave of the highest pitch the
+# oscillator can reach with its tuning and bend range is swapped in on press
+wavetables = [None] * OSCILLATORS
+
+def set_waveform(index:int, value:int, item:synthmenu.Item) -> None:
+    shape = waveforms[value % len(waveforms)][2]
+    if shape is None:
+        wavetables[index] = None
+    else:
+        wavetables[index] = wavetable.get(shape, hardware.SAMPLE_RATE)
+        wavetables[index].generate()
+    menu.set_attribute(oscillators[index::OSCILLATORS], 'waveform', item.data)
+
 async def oscillator_task() -> None:
     while True:
         for i in range(len(oscillators)):
             oscillators[i].update()
         await asyncio.sleep(hardware.TASK_SLEEP)
 
+## Modulation
+
+# Each oscillator group can either use the LFOs of its individual oscillators or a single shared set
+lfos = [lfo.GlobalLFO(synth) for i in range(OSCILLATORS)]
+lfo_modes = (("Voice", lfo.Mode.VOICE), ("Global", lfo.Mode.GLOBAL))
+lfo_mode = [lfo.Mode.VOICE] * OSCILLATORS
+lfo_values = [{} for i in range(OSCILLATORS)]
+
+def set_lfo_attribute(index:int, name:str, value:float) -> None:
+    lfo_values[index][name] = value
+    if lfo_mode[index] == lfo.Mode.GLOBAL:
+        menu.set_attribute(lfos[index], name, value)
+        if not name.endswith('_delay'):
+            value = 0.0 # Park oscillator lfos
+    menu.set_attribute(oscillators[index::OSCILLATORS], name, value)
+
+def set_lfo_mode(index:int, value:int, item:synthmenu.Item = None) -> None:
+    lfo_mode[index] = lfo_modes[value % len(lfo_modes)][1]
+    lfos[index].active = lfo_mode[index] == lfo.Mode.GLOBAL
+    for name, data in lfo_values[index].items():
+        set_lfo_attribute(index, name, data)
+    if settings.performance_telemetry:
+        print("lfo: group={:d} mode={:s} blocks={:d}".format(index, lfo_modes[value % len(lfo_modes)][0], lfo.get_block_count(synth, [note for oscillator in oscillators for note in oscillator.notes])))
+
 ## Keyboard Manager
 
 keyboard = synthkeyboard.Keyboard(
@@ -106,6 +158,9 @@ keyboard = synthkeyboard.Keyboard(
     root=48,
 )
 
+# Reduce polyphony when processing headroom runs out
+governor = Governor(keyboard, VOICES)
+
 class VoiceType:
     POLYPHONIC = const(0)
     MONOPHONIC = const(1)
@@ -116,8 +171,9 @@ voice_type = VoiceType.POLYPHONIC
 def set_voice_type(value:int, item:synthmenu.Item = None) -> None:
     global voice_type
     voice_type = value % len(voice_types)
+    governor.active = voice_type == VoiceType.POLYPHONIC
     if voice_type == VoiceType.POLYPHONIC:
-        keyboard.max_voices = VOICES
+        keyboard.max_voices = governor.voices
     else:
         keyboard.max_voices = 1
 
@@ -131,10 +187,19 @@ def voice_press(voice:synthvoice.Voice) -> None:
     elif voice_type == VoiceType.MONOPHONIC_ALL:
         stop = len(oscillators)
     for i in range(start, stop):
+        if (table := wavetables[i % OSCILLATORS]) is not None:
+            oscillators[i].waveform = table.get(wavetable.get_pitch(
+                voice.note.notenum,
+                oscillators[i].coarse_tune,
+                oscillators[i].fine_tune,
+                oscillators[i].bend_amount,
+            ))
         oscillators[i].press(
             notenum=voice.note.notenum,
             velocity=voice.note.velocity,
         )
+        lfos[i % OSCILLATORS].bind(oscillators[i])
+    midi.record_press()
     hardware.led.value = True
 keyboard.on_voice_press = voice_press
 
@@ -156,48 +221,10 @@ keyboard.arpeggiator = synthkeyboard.Arpeggiator(
 
 ## USB & Hardware MIDI
 
-def midi_process_message(msg:MIDIMessage) -> None:
-    if settings.midi_thru and not isinstance(msg, MIDIUnknownEvent):
-        hardware.midi_usb.send(msg)
-        hardware.midi_uart.send(msg)
-
-    if settings.midi_channel is not None and msg.channel != settings.midi_channel:
-        return
-    
-    if isinstance(msg, NoteOn):
-        if msg.velocity > 0.0:
-            keyboard.append(msg.note, msg.velocity)
-        else:
-            keyboard.remove(msg.note)
-
-    elif isinstance(msg, NoteOff):
-        keyboard.remove(msg.note)
-
-    elif isinstance(msg, ControlChange):
-        if msg.control == 7: # Volume
-            mixer.voice[0].level = msg.value / 127
-        elif msg.control == 10: # Pan
-            menu.set_attribute(oscillators, 'pan', msg.value / 64 - 1)
-        elif msg.control == 11: # Expression
-            menu.set_attribute(oscillators, 'velocity_amount', msg.value / 127)
-        elif msg.control == 64: # Sustain
-            keyboard.sustain = msg.value >= 64
-
-    elif isinstance(msg, PitchBend):
-        menu.set_attribute(oscillators, 'bend', (msg.pitch_bend - 8192) / 8192)
-    
-def midi_process_messages(midi:adafruit_midi.MIDI, limit:int = 32) -> None:
-    while limit:
-        if not (msg := midi.receive()):
-            break
-        midi_process_message(msg)
-        limit -= 1
-
-async def midi_task() -> None:
-    while True:
-        midi_process_messages(hardware.midi_usb)
-        midi_process_messages(hardware.midi_uart)
-        await asyncio.sleep(hardware.TASK_SLEEP)
+router = midi.get_router(keyboard, mixer, oscillators)
+clock = Clock(keyboard.arpeggiator)
+clock.attach(router)
+control_map = ControlMap(router, 'synthesizer')
 
 ## Touch Keyboard Interface
 
@@ -207,8 +234,7 @@ def ttp_press(i:int) -> None:
         keyboard.append(notenum)
     if settings.midi_touch_out:
         msg = NoteOn(notenum)
-        hardware.midi_uart.send(msg)
-        hardware.midi_usb.send(msg)
+        midi.send(msg)
 hardware.ttp.on_press = ttp_press
 
 def ttp_release(i:int) -> None:
@@ -217,8 +243,7 @@ def ttp_release(i:int) -> None:
         keyboard.remove(notenum)
     if settings.midi_touch_out:
         msg = NoteOff(notenum)
-        hardware.midi_uart.send(msg)
-        hardware.midi_usb.send(msg)
+        midi.send(msg)
 hardware.ttp.on_release = ttp_release
 
 async def touch_task() -> None:
@@ -228,6 +253,17 @@ async def touch_task() -> None:
 
 ## Character LCD Menu
 
+# Read all patches into memory to avoid storage access when switching
+menu.load_patches('synthesizer')
+
+def load_patch(value:int, item:synthmenu.Item) -> None:
+    menu.load_patch(lcd_menu, item, value, 'synthesizer')
+    control_map.load(value)
+
+def save_patch() -> None:
+    if menu.save_patch(lcd_menu, patch.value, 'synthesizer'):
+        control_map.save(patch.value)
+
 def copy_oscillator_attrs(index:int = 0) -> None:
     if OSCILLATORS > 1:
         menu.write_message("Copying...")
@@ -254,10 +290,10 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
                 maximum=15,
                 loop=True,
                 decimals=0,
-                on_update=lambda value, item: menu.load_patch(lcd_menu, item, value, 'synthesizer'),
+                on_update=load_patch,
             ),
             synthmenu.String("Name"),
-            synthmenu.Action("Save", lambda: menu.save_patch(lcd_menu, patch.value, 'synthesizer')),
+            synthmenu.Action("Save", save_patch),
         )),
         synthmenu.Group("Audio", (
             synthmenu.Percentage(
@@ -297,14 +333,8 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
             ),
             synthmenu.Waveform(
                 title="Waveform",
-                items=(
-                    ("Sine", synthwaveform.sine),
-                    ("Saw", synthwaveform.saw),
-                    ("Triangle", synthwaveform.triangle),
-                    ("Square", synthwaveform.square),
-                    ("Noise", synthwaveform.noise),
-                ),
-                on_waveform_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'waveform', item.data),
+                items=tuple([item[:2] for item in waveforms]),
+                on_waveform_update=lambda value, item, i=i: set_waveform(i, value, item),
                 on_loop_start_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'waveform_loop', (value, oscillators[i].waveform_loop[1])),
                 on_loop_end_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'waveform_loop', (oscillators[i].waveform_loop[0], value)),
             ),
@@ -396,10 +426,15 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
                 )),
             )),
             synthmenu.Group("Mod", (
+                synthmenu.List(
+                    title="Mode",
+                    items=tuple([item[0] for item in lfo_modes]),
+                    on_update=lambda value, item, i=i: set_lfo_mode(i, value, item),
+                ),
                 synthmenu.Group("Tremolo", (
                     synthmenu.Percentage(
                         title="Depth",
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'tremolo_depth', value / 2),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'tremolo_depth', value / 2),
                     ),
                     synthmenu.Number(
                         title="Rate",
@@ -407,14 +442,14 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
                         maximum=32.0,
                         smoothing=2.0,
                         append="hz",
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'tremolo_rate', value),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'tremolo_rate', value),
                     ),
                     synthmenu.Time(
                         title="Delay",
                         step=0.01,
                         minimum=0.0,
                         maximum=10.0,
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'tremolo_delay', value),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'tremolo_delay', value),
                     ),
                 )),
                 synthmenu.Group("Vibrato", (
@@ -426,7 +461,7 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
                         maximum=600,
                         decimals=0,
                         append=" cents",
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'vibrato_depth', value / 1200),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'vibrato_depth', value / 1200),
                     ),
                     synthmenu.Number(
                         title="Rate",
@@ -434,20 +469,20 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
                         maximum=32.0,
                         smoothing=2.0,
                         append="hz",
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'vibrato_rate', value),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'vibrato_rate', value),
                     ),
                     synthmenu.Time(
                         title="Delay",
                         step=0.01,
                         minimum=0.0,
                         maximum=10.0,
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'vibrato_delay', value),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'vibrato_delay', value),
                     ),
                 )),
                 synthmenu.Group("Pan", (
                     synthmenu.Percentage(
                         title="Depth",
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'pan_depth', value),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'pan_depth', value),
                     ),
                     synthmenu.Number(
                         title="Rate",
@@ -455,20 +490,21 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
                         maximum=32.0,
                         smoothing=2.0,
                         append="hz",
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'pan_rate', value),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'pan_rate', value),
                     ),
                     synthmenu.Time(
                         title="Delay",
                         step=0.01,
                         minimum=0.0,
                         maximum=10.0,
-                        on_update=lambda value, item, i=i: menu.set_attribute(oscillators[i::OSCILLATORS], 'pan_delay', value),
+                        on_update=lambda value, item, i=i: set_lfo_attribute(i, 'pan_delay', value),
                     ),
                 )),
             )),
         )) for i in range(OSCILLATORS)
     ] + ([
         synthmenu.Group("Effects", (
+            synthmenu.Action(lambda item: "Chain: " + str(chain), chain.update),
             synthmenu.Group("Chorus", (
                 synthmenu.Percentage(
                     title="Depth",
@@ -484,7 +520,7 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
                 ),
                 synthmenu.Percentage(
                     title="Mix",
-                    on_update=lambda value, item: menu.set_attribute(chorus, 'mix', value),
+                    on_update=lambda value, item: chain.set_attribute(chorus, 'mix', value),
                 ),
             )),
             synthmenu.Group("Delay", (
@@ -505,7 +541,7 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
                 ),
                 synthmenu.Percentage(
                     title="Mix",
-                    on_update=lambda value, item: menu.set_attribute(delay, 'mix', value),
+                    on_update=lambda value, item: chain.set_attribute(delay, 'mix', value),
                 ),
             )),
         )),
@@ -513,11 +549,13 @@ lcd_menu = synthmenu.character_lcd.Menu(hardware.lcd, hardware.COLUMNS, hardware
         synthmenu.Group("Tools", tuple([
             synthmenu.Action("Copy Osc {:d}".format(i+1), lambda i=i: copy_oscillator_attrs(i)) for i in range(OSCILLATORS)
         ])),
-    ] if OSCILLATORS > 1 else []) + [
+    ] if OSCILLATORS > 1 else []) + [control_map.group()] + ([telemetry.group()] if settings.performance_telemetry else []) + [
         synthmenu.Action("Exit", menu.load_launcher),
     ]
 ))
 
+control_map.attach(lcd_menu)
+
 # Perform a full update which will synchronize oscillator properties
 
 lcd_menu.do_update()
@@ -536,8 +574,12 @@ async def main():
         asyncio.create_task(keyboard.arpeggiator.update()),
         asyncio.create_task(oscillator_task()),
         asyncio.create_task(touch_task()),
-        asyncio.create_task(midi_task()),
+        asyncio.create_task(router.update()),
         asyncio.create_task(controls_task()),
+        asyncio.create_task(governor.update()),
+        asyncio.create_task(midi.update()),
+        asyncio.create_task(telemetry.update()),
+        *([asyncio.create_task(chain.task())] if EFFECTS else []),
     )
 
 asyncio.run(main())
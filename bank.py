@@ -0,0 +1,170 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Sample banks which pack many samples into a single file behind an index header
+#
+# Layout (little endian):
+#     header: magic "SBNK", version (u16), count (u16), padded to ALIGN
+#     entries: name (24 bytes), offset (u32), length (u32), sample rate (u32), root note (u8),
+#              fine tune in cents (i8), flags (u16), loop start (u32), loop end (u32)
+#     data: mono 16-bit PCM of each sample, starting on a multiple of ALIGN
+#
+# Samples within a bank are referred to by the path of the bank and the sample name, ie:
+# "/samples/piano.bank#c4". Only the separator following the extension of the bank marks an entry, so
+# file and sample names may contain sharps, ie: "/samples/piano-C#4.wav". Usage on host: python3 bank.py [-r RATE] [-d] -o OUTPUT FILE...
+
+import struct
+
+MAGIC = b'SBNK'
+VERSION = 1
+HEADER = '<4sHH'
+ENTRY = '<24sIIIBbHII'
+NAME = 24 # Maximum length of sample names (bytes)
+ALIGN = 512 # Alignment of header and sample data to storage sectors (bytes)
+SEPARATOR = "#"
+EXTENSION = ".bank"
+
+FLAG_LOOP = 1
+
+class Entry:
+    def __init__(self, name:str, offset:int, length:int, sample_rate:int, root:int = 60, tune:float = 0.0, loop:tuple = None):
+        self.name = name
+        self.offset = offset
+        self.length = length # Samples
+        self.sample_rate = sample_rate
+        self.root = root
+        self.tune = tune
+        self.loop = loop
+
+class Bank:
+    """Index of the samples within a bank file. The header is read once so that samples can be
+    listed without directory lookups, and each sample is read with a single seek into a provided
+    buffer.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self._file = open(path, "rb")
+        magic, version, count = struct.unpack(HEADER, self._file.read(struct.calcsize(HEADER)))
+        if magic != MAGIC or version != VERSION:
+            self._file.close()
+            raise ValueError("Invalid sample bank")
+        self._file.seek(ALIGN)
+        data = self._file.read(count * struct.calcsize(ENTRY))
+        self.entries = []
+        for i in range(count):
+            name, offset, length, sample_rate, root, tune, flags, loop_start, loop_end = struct.unpack_from(ENTRY, data, i * struct.calcsize(ENTRY))
+            self.entries.append(Entry(
+                name=name.rstrip(b'\x00').decode(),
+                offset=offset,
+                length=length,
+                sample_rate=sample_rate,
+                root=root,
+                tune=tune / 100,
+                loop=(loop_start, loop_end) if flags & FLAG_LOOP else None,
+            ))
+        self.entries = tuple(self.entries)
+        self._names = dict([(entry.name, entry) for entry in self.entries])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_paths(self) -> tuple:
+        return tuple([self.path + SEPARATOR + entry.name for entry in self.entries])
+
+    def find(self, name:str) -> Entry|None:
+        return self._names.get(name)
+
+    def readinto(self, entry:Entry, buffer:object) -> int:
+        self._file.seek(entry.offset)
+        return self._file.readinto(buffer)
+
+    def close(self) -> None:
+        self._file.close()
+
+# Banks remain open once read so that their headers are only parsed once
+_banks = {}
+
+def is_entry(path:str) -> bool:
+    return (EXTENSION + SEPARATOR) in path
+
+def split(path:str) -> tuple:
+    """Get the path of the bank and the sample name of a path within a bank."""
+    path, name = path.split(EXTENSION + SEPARATOR, 1)
+    return path + EXTENSION, name
+
+def load(path:str) -> Bank:
+    if (bank := _banks.get(path)) is None:
+        bank = _banks[path] = Bank(path)
+    return bank
+
+def get(path:str) -> tuple:
+    """Get the bank and entry of a sample path within a bank."""
+    path, name = split(path)
+    bank = load(path)
+    if (entry := bank.find(name)) is None:
+        raise ValueError("Sample not in bank")
+    return bank, entry
+
+def pack(path:str, samples:list) -> int:
+    """Write a bank from a list of (name, data, sample rate, root, tune, loop) where data is an int16
+    array. Returns the size of the bank in bytes.
+    """
+    entry_size = struct.calcsize(ENTRY)
+    offset = ALIGN + (len(samples) * entry_size + ALIGN - 1) // ALIGN * ALIGN
+    entries = []
+    for name, data, sample_rate, root, tune, loop in samples:
+        entries.append(struct.pack(
+            ENTRY, name.encode()[:NAME], offset, len(data), sample_rate, root, round(tune * 100),
+            FLAG_LOOP if loop is not None else 0,
+            loop[0] if loop is not None else 0,
+            loop[1] if loop is not None else 0,
+        ))
+        offset += (len(data) * 2 + ALIGN - 1) // ALIGN * ALIGN
+
+    with open(path, "wb") as file:
+        file.write(struct.pack(HEADER, MAGIC, VERSION, len(samples)))
+        file.seek(ALIGN)
+        file.write(b''.join(entries))
+        for i, sample in enumerate(samples):
+            file.seek(struct.unpack_from('<I', entries[i], NAME)[0])
+            file.write(sample[1].tobytes())
+        file.truncate(offset)
+    return offset
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import numpy as np
+    import wav
+    import pitch
+    import preprocess
+
+    parser = argparse.ArgumentParser(description="Pack WAV samples into a sample bank for the sampler")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-o", "--output", required=True, help="bank file, ie: samples/instruments.bank")
+    parser.add_argument("-r", "--rate", type=int, default=None, help="target sample rate, ie: 44100")
+    parser.add_argument("-d", "--detect", action="store_true", help="detect root note of samples without smpl chunk")
+    args = parser.parse_args()
+
+    samples = []
+    for path in args.files:
+        data, rate = preprocess.read(path)
+        with open(path, "rb") as file:
+            root, loop = wav.read_sampler(file)
+        tune = 0.0
+        if args.rate is not None and args.rate != rate:
+            if loop is not None:
+                loop = (int(loop[0] * args.rate / rate), int(loop[1] * args.rate / rate))
+            data, rate = preprocess.resample(data, rate, args.rate), args.rate
+        if root is None:
+            root = 60
+            if args.detect and (frequency := pitch.detect(data, rate)[0]) > 0.0:
+                root, tune = pitch.to_note(frequency)
+        name = os.path.splitext(os.path.basename(path))[0][:NAME]
+        samples.append((name, np.array(np.clip(data, -32768, 32767), dtype=np.int16), rate, root, tune, loop))
+        print("{:s}: length={:d} rate={:d} root={:d} loop={:s}".format(
+            name, len(data), rate, root, "{:d}-{:d}".format(*loop) if loop is not None else "none"
+        ))
+    print("{:s}: samples={:d} bytes={:d}".format(args.output, len(samples), pack(args.output, samples)))
@@ -0,0 +1,147 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# External MIDI clock synchronization of arpeggiator and sequencer timers
+
+import time
+import synthkeyboard
+
+import midi
+import midiport
+import settings
+import telemetry
+
+PPQN = 24 # MIDI timing clock ticks per quarter note
+
+class Clock:
+    """Follows the MIDI timing clock of an external device and drives the tempo of a timer, such as
+    :class:`synthkeyboard.Arpeggiator` or :class:`synthkeyboard.Sequencer`. The tempo is estimated
+    with a least squares fit over the most recent ticks to filter out transport jitter, and the phase
+    of each step is compared against the tick on which it should have landed. The phase error is fed
+    back into the tempo of the timer so that its steps stay aligned to the clock.
+    """
+
+    def __init__(self, timer:synthkeyboard.Timer, transport:bool = False, size:int = 48, gain:float = 0.1, timeout:float = 0.5):
+        self._timer = timer
+        self._transport = transport
+        self._size = size
+        self._gain = gain
+        self._timeout = int(timeout * 1000000000)
+        self._ticks = []
+        self._count = 0
+        self._period = 0.0 # Estimated tick period (ns)
+        self._boundary = None
+        self._phase = 0.0
+        self._bpm = None
+        self._internal = timer.bpm
+        self._on_step = timer.on_step
+        timer.on_step = self._step
+
+    @property
+    def locked(self) -> bool:
+        return self._bpm is not None
+
+    @property
+    def bpm(self) -> float:
+        return self._bpm if self._bpm is not None else self._timer.bpm
+
+    def attach(self, router:midi.Router) -> None:
+        """Handle clock and transport messages of a router. Messages are ignored while the clock
+        setting is disabled, which may change at any time.
+        """
+        router.set_handler(midiport.TIMING_CLOCK, self._tick)
+        router.set_handler(midiport.START, self._start)
+        router.set_handler(midiport.CONTINUE, self._continue)
+        router.set_handler(midiport.STOP, self._stop)
+
+    def _get_ticks_per_step(self) -> int:
+        return max(round(PPQN / self._timer.steps), 1)
+
+    def _tick(self, status:int, data1:int, data2:int) -> None:
+        if not settings.midi_clock:
+            return
+        if (now := midi.get_timestamp()) is None:
+            now = time.monotonic_ns()
+
+        # Restart estimation after a break in the clock or a sudden change in tempo
+        if self._ticks and (now - self._ticks[-1] > self._timeout or (self._period and now - self._ticks[-1] > self._period * 4)):
+            self._ticks = []
+        self._ticks.append(now)
+        if len(self._ticks) > self._size:
+            self._ticks.pop(0)
+
+        if self._count % self._get_ticks_per_step() == 0:
+            self._boundary = now
+        self._count += 1
+
+        if len(self._ticks) < PPQN // 4:
+            return
+        self._period = self._estimate()
+        if self._period <= 0.0:
+            return
+
+        locked = self._bpm is not None
+        if not locked:
+            self._internal = self._timer.bpm
+        self._bpm = 60000000000 / (self._period * PPQN)
+        if not locked and settings.performance_telemetry:
+            print("clock: locked bpm={:.1f}".format(self._bpm))
+
+        # Nudge the tempo of the timer towards the phase of the clock
+        correction = min(max(self._phase * self._gain, -0.1), 0.1)
+        self._timer.bpm = self._bpm * (1.0 + correction)
+
+    def _estimate(self) -> float:
+        ticks = self._ticks
+        count = len(ticks)
+        first = ticks[0]
+        center = (count - 1) / 2
+        mean = sum([tick - first for tick in ticks]) / count
+        covariance = 0.0
+        for i, tick in enumerate(ticks):
+            covariance += (i - center) * (tick - first - mean)
+        return covariance / (count * (count * count - 1) / 12)
+
+    def _step(self, position:int) -> None:
+        now = time.monotonic_ns()
+        if self._bpm is not None:
+            if not self._ticks or now - self._ticks[-1] > self._timeout:
+                self._unlock()
+            elif self._boundary is not None:
+                period = self._period * self._get_ticks_per_step()
+                phase = (now - self._boundary) / period
+                phase -= round(phase)
+                self._phase = phase
+                telemetry.jitter.append(phase * period / 1000000)
+        if self._on_step is not None:
+            self._on_step(position)
+
+    def _unlock(self) -> None:
+        if settings.performance_telemetry:
+            print("clock: unlocked bpm={:.1f}".format(self._bpm))
+        self._bpm = None
+        self._ticks = []
+        self._boundary = None
+        self._phase = 0.0
+        self._timer.bpm = self._internal
+
+    def _start(self, status:int, data1:int, data2:int) -> None:
+        if not settings.midi_clock:
+            return
+        self._count = 0
+        self._boundary = None
+        self._phase = 0.0
+        # Restart the timer so that its first step lands on the first tick after start
+        active = self._timer.active
+        self._timer.active = False
+        if self._transport or active:
+            self._timer.active = True
+
+    def _continue(self, status:int, data1:int, data2:int) -> None:
+        if settings.midi_clock and self._transport:
+            self._timer.active = True
+
+    def _stop(self, status:int, data1:int, data2:int) -> None:
+        if settings.midi_clock and self._transport:
+            self._timer.active = False
@@ -0,0 +1,192 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Decoding (and encoding on host) of IMA ADPCM and µ-law compressed sample data
+#
+# Usage on host: python3 codec.py [-f adpcm|mulaw] [-b BLOCK] -o OUTPUT FILE...
+#                python3 codec.py --benchmark [-b BLOCK] [-n BLOCKS] FILE...
+
+try:
+    import ulab.numpy as np
+except ImportError:
+    import numpy as np
+
+BLOCK = 64 # Bytes per ADPCM block and channel, smaller blocks are decoded with more parallelism
+BLOCKS = 32 # ADPCM blocks decoded at once
+
+STEPS = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66,
+    73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449,
+    494, 544, 598, 658, 724, 796, 876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272,
+    2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767,
+)
+ADJUST = (-1, -1, -1, -1, 2, 4, 6, 8)
+
+def _get_difference(step:int, code:int) -> int:
+    difference = step >> 3
+    if code & 4:
+        difference += step
+    if code & 2:
+        difference += step >> 1
+    if code & 1:
+        difference += step >> 2
+    return -difference if code & 8 else difference
+
+# Lookup tables indexed by step index * 16 + code so that each decoded sample costs a few array
+# operations regardless of the number of blocks decoded together
+DIFFERENCE = np.array([_get_difference(STEPS[i >> 4], i & 15) for i in range(len(STEPS) * 16)])
+NEXT = np.array([min(max((i >> 4) + ADJUST[i & 7], 0), len(STEPS) - 1) for i in range(len(STEPS) * 16)], dtype=np.int16)
+LOW = np.array([i & 15 for i in range(256)], dtype=np.int16)
+HIGH = np.array([i >> 4 for i in range(256)], dtype=np.int16)
+
+def _get_mulaw(code:int) -> int:
+    code = ~code & 0xff
+    value = (((code & 0x0f) << 3) + 0x84) << ((code >> 4) & 7)
+    return 0x84 - value if code & 0x80 else value - 0x84
+
+MULAW = np.array([_get_mulaw(i) for i in range(256)], dtype=np.int16)
+
+def decode_mulaw(data:object, channels:int = 1, channel:int = 0) -> np.ndarray:
+    """Decode one channel of 8-bit µ-law data into 16-bit samples."""
+    return np.take(MULAW, np.frombuffer(data, dtype=np.uint8)[channel::channels])
+
+def get_block_samples(block_align:int, channels:int = 1) -> int:
+    # The first sample of each channel is stored within the block header
+    return (block_align - 4 * channels) * 2 // channels + 1
+
+def get_offset(index:int, channels:int = 1, channel:int = 0) -> tuple:
+    """Get the byte offset and nibble table of a sample within an IMA ADPCM block, not including the
+    first sample within the header.
+    """
+    index -= 1
+    return 4 * channels + (index >> 3) * 4 * channels + channel * 4 + ((index & 7) >> 1), HIGH if index & 1 else LOW
+
+def decode_adpcm(data:object, block_align:int, channels:int = 1, channel:int = 0) -> np.ndarray:
+    """Decode one channel of whole IMA ADPCM blocks into 16-bit samples. Each block has its own
+    initial state, so every block is decoded at once by stepping through the sample positions of all
+    blocks together.
+    """
+    blocks = len(data) // block_align
+    rows = np.frombuffer(data, dtype=np.uint8, count=blocks * block_align).reshape((blocks, block_align))
+    count = get_block_samples(block_align, channels)
+    output = np.zeros((blocks, count), dtype=np.int16)
+
+    header = channel * 4
+    predictor = rows[:, header] + rows[:, header + 1] * 256.0
+    predictor = predictor - (predictor >= 32768) * 65536.0
+    index = np.array(np.clip(rows[:, header + 2], 0, len(STEPS) - 1), dtype=np.int16)
+    output[:, 0] = predictor
+    for i in range(1, count):
+        offset, nibbles = get_offset(i, channels, channel)
+        code = index * 16 + np.take(nibbles, rows[:, offset])
+        predictor = np.clip(predictor + np.take(DIFFERENCE, code), -32768, 32767)
+        index = np.take(NEXT, code)
+        output[:, i] = predictor
+    return output.reshape((blocks * count,))
+
+def encode_mulaw(data:np.ndarray) -> bytes:
+    data = np.clip(np.array(data, dtype=np.int32), -32635, 32635)
+    sign = (data < 0) * 0x80
+    data = np.abs(data) + 0x84
+    exponent = np.floor(np.log2(data)).astype(np.int32) - 7
+    mantissa = (data >> (exponent + 3)) & 0x0f
+    return (~(sign | (exponent << 4) | mantissa) & 0xff).astype(np.uint8).tobytes()
+
+def encode_adpcm(data:np.ndarray, block_align:int, channels:int = 1) -> bytes:
+    """Encode interleaved 16-bit samples into IMA ADPCM blocks with the final block padded with
+    silence. Blocks are encoded together in the same manner as :func:`decode_adpcm`.
+    """
+    count = get_block_samples(block_align, channels)
+    frames = len(data) // channels
+    blocks = (frames + count - 1) // count
+    padded = np.zeros(blocks * count * channels, dtype=np.int32)
+    padded[:frames * channels] = data[:frames * channels]
+    rows = np.zeros((blocks, block_align), dtype=np.uint8)
+    for channel in range(channels):
+        samples = padded[channel::channels].reshape((blocks, count))
+        predictor = samples[:, 0].copy()
+        # Blocks can't carry state between each other, so start from the average slope of each block
+        index = np.minimum(np.searchsorted(STEPS, np.mean(np.abs(np.diff(samples, axis=1)), axis=1)), len(STEPS) - 1).astype(np.int32)
+        rows[:, channel * 4] = predictor & 0xff
+        rows[:, channel * 4 + 1] = (predictor >> 8) & 0xff
+        rows[:, channel * 4 + 2] = index
+        for i in range(1, count):
+            difference = samples[:, i] - predictor
+            step = np.take(STEPS, index)
+            code = (difference < 0) * 8
+            difference = np.abs(difference)
+            for bit, shift in ((4, 0), (2, 1), (1, 2)):
+                match = difference >= (step >> shift)
+                code |= match * bit
+                difference -= match * (step >> shift)
+            table = index * 16 + code
+            predictor = np.clip(predictor + np.take(DIFFERENCE, table), -32768, 32767).astype(np.int32)
+            index = np.take(NEXT, table).astype(np.int32)
+            offset, nibbles = get_offset(i, channels, channel)
+            rows[:, offset] |= (code << 4 if nibbles is HIGH else code).astype(np.uint8)
+    return rows.tobytes()
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import time
+    import wav
+
+    parser = argparse.ArgumentParser(description="Compress WAV samples and songs as IMA ADPCM or µ-law")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-f", "--format", choices=("adpcm", "mulaw"), default="adpcm")
+    parser.add_argument("-b", "--block", type=int, default=BLOCK, help="ADPCM bytes per block and channel")
+    parser.add_argument("-o", "--output", default=None, help="output directory")
+    parser.add_argument("-n", "--blocks", type=int, default=BLOCKS, help="ADPCM blocks decoded at once when benchmarking")
+    parser.add_argument("--benchmark", action="store_true", help="compare decode speed against reading PCM")
+    args = parser.parse_args()
+
+    if args.output is not None and not args.benchmark:
+        os.makedirs(args.output, exist_ok=True)
+    for path in args.files:
+        with open(path, "rb") as file:
+            fmt, channels, sample_rate, bits, block_align, offset, length = wav.read_header(file)
+            if fmt != wav.FORMAT_PCM or bits != 16:
+                print("{:s}: unsupported format".format(path))
+                continue
+            data = np.frombuffer(file.read(length - length % block_align), dtype=np.int16)
+
+        adpcm_align = args.block * channels
+        adpcm = encode_adpcm(data, adpcm_align, channels)
+        mulaw = encode_mulaw(data)
+
+        if args.benchmark:
+            def measure(function:callable) -> float:
+                start = time.perf_counter()
+                for i in range(10):
+                    function()
+                return (time.perf_counter() - start) / 10
+            frames = len(data) // channels
+            seconds = frames / sample_rate
+            raw = measure(lambda: np.frombuffer(open(path, "rb").read(), dtype=np.uint8))
+            results = (
+                ("pcm", len(data) * 2, raw),
+                ("mulaw", len(mulaw), measure(lambda: decode_mulaw(mulaw, channels))),
+                ("adpcm", len(adpcm), measure(lambda: decode_adpcm(adpcm, adpcm_align, channels))),
+                # Decoding all channels a group of blocks at a time as when streaming
+                ("adpcm-stream", len(adpcm), measure(lambda: [
+                    decode_adpcm(adpcm[i:i + adpcm_align * args.blocks], adpcm_align, channels, channel)
+                    for i in range(0, len(adpcm), adpcm_align * args.blocks) for channel in range(channels)
+                ])),
+            )
+            for name, size, duration in results:
+                print("{:s}: {:s} bytes={:d} ratio={:.2f} time={:.2f}ms per_second={:.2f}ms".format(
+                    path, name, size, len(data) * 2 / size, duration * 1000, duration * 1000 / seconds
+                ))
+            error = np.abs(decode_adpcm(adpcm, adpcm_align, channels)[:frames].astype(np.int32) - data[::channels])
+            print("{:s}: adpcm error mean={:.1f} max={:d}".format(path, float(np.mean(error)), int(np.max(error))))
+            continue
+
+        output = os.path.join(args.output, os.path.basename(path)) if args.output is not None else path
+        if args.format == "adpcm":
+            wav.write_format(output, wav.FORMAT_IMA_ADPCM, channels, sample_rate, 4, adpcm_align, adpcm, len(data) // channels, get_block_samples(adpcm_align, channels))
+        else:
+            wav.write_format(output, wav.FORMAT_MULAW, channels, sample_rate, 8, channels, mulaw, len(data) // channels)
+        print("{:s}: {:s} bytes={:d}".format(output, args.format, len(adpcm if args.format == "adpcm" else mulaw)))
@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Control change routing to menu items with MIDI learn
+
+import synthmenu
+
+import menu
+import midi
+
+def get_leaves(group:synthmenu.Group, path:str = "") -> list[tuple[str, synthmenu.Item]]:
+    # Unlike menu.get_items, composite items are broken down into their individual parameters. Each
+    # item is identified by the titles of its groups, ie: "Osc 1/Filter/Cutoff", so that stored routes
+    # remain valid when items are added to the menu.
+    items = []
+    for i in range(len(group)):
+        item = group[i]
+        if type(item.title) is not str:
+            continue
+        title = path + "/" + item.title if path else item.title
+        if isinstance(item, synthmenu.Group):
+            items.extend(get_leaves(item, title))
+        else:
+            items.append((title, item))
+    return items
+
+def get_setter(item:synthmenu.Item) -> callable:
+    """Create a function which scales a control change value (0-127) to the range of a menu item and
+    updates it. Returns `None` if the item can't be controlled.
+    """
+    if isinstance(item, synthmenu.Bool):
+        convert = lambda value: value >= 64
+    elif isinstance(item, synthmenu.List):
+        count = len(item.items)
+        convert = lambda value: value * count // 128
+    elif isinstance(item, synthmenu.Number):
+        minimum, scale = item.minimum, (item.maximum - item.minimum) / 127
+        if type(item.minimum) is int and type(item.maximum) is int:
+            convert = lambda value: minimum + round(value * scale)
+        else:
+            convert = lambda value: minimum + value * scale
+    else:
+        return None
+
+    def setter(value:int) -> None:
+        value = convert(value)
+        if item.data != value:
+            item.data = value
+            item.do_update()
+    return setter
+
+class ControlMap:
+    """Table of control change handlers indexed by channel and control number which is placed in front
+    of the control change handling of a router. Each entry is a setter bound to a menu item when the
+    table is loaded, so that incoming messages only cost a single lookup. Messages without an entry
+    fall through to the router. Routes are stored alongside each patch by the path of their item.
+    """
+
+    def __init__(self, router:midi.Router, prepend:str = 'patch'):
+        self._prepend = prepend + '-cc'
+        self._menu = None
+        self._items = {}
+        self._routes = {}
+        self._table = [None] * (16 * 128)
+        self._learn = False
+        self._fallback = router.get_handler(midi.CONTROL_CHANGE)
+        router.set_handler(midi.CONTROL_CHANGE, self.process_message)
+        menu.load_patches(self._prepend)
+
+    @property
+    def learning(self) -> bool:
+        return self._learn
+
+    def attach(self, lcd_menu:synthmenu.Menu) -> None:
+        self._menu = lcd_menu
+        self._items = {}
+        for path, item in get_leaves(lcd_menu):
+            if path not in self._items:
+                self._items[path] = item
+
+    def assign(self, channel:int, control:int, setter:callable) -> None:
+        """Assign a callback which receives the value (0-127) of a control change number on a channel
+        (0-15). Callbacks assigned directly are not stored with the patch.
+        """
+        self._table[(channel & 0x0f) << 7 | (control & 0x7f)] = setter
+
+    def get_path(self, item:synthmenu.Item) -> str|None:
+        for path, leaf in self._items.items():
+            if leaf is item:
+                return path
+        return None
+
+    def route(self, channel:int, control:int, item:synthmenu.Item) -> bool:
+        if (path := self.get_path(item)) is None or (setter := get_setter(item)) is None:
+            return False
+        key = (channel & 0x0f) << 7 | (control & 0x7f)
+        self._routes[key] = path
+        self._table[key] = setter
+        return True
+
+    def clear(self) -> None:
+        for key in self._routes:
+            self._table[key] = None
+        self._routes = {}
+
+    def learn(self) -> None:
+        """Route the next control change received to the selected menu item."""
+        self._learn = not self._learn
+        menu.write_message("Move control..." if self._learn else "Cancelled")
+
+    def process_message(self, status:int, control:int, value:int) -> None:
+        if self._learn and self._menu is not None:
+            item = self._menu.selected.current_item
+            if self.route(status & 0x0f, control, item):
+                self._learn = False
+                menu.write_message("CC{:d} > {:s}".format(control, item.title))
+        if (setter := self._table[(status & 0x0f) << 7 | control]) is not None:
+            setter(value)
+        elif self._fallback is not None:
+            self._fallback(status, control, value)
+
+    def load(self, value:int) -> None:
+        self.clear()
+        for key, path in (menu.read_patch(value, self._prepend) or []):
+            if type(path) is str and (item := self._items.get(path)) is not None:
+                self.route(key >> 7, key & 0x7f, item)
+
+    def save(self, value:int) -> bool:
+        return menu.write_patch([[key, path] for key, path in self._routes.items()], value, self._prepend)
+
+    def group(self) -> synthmenu.Group:
+        return synthmenu.Group("Control", (
+            synthmenu.Action(lambda item: "Learning..." if self._learn else "Learn", self.learn),
+            synthmenu.Action(lambda item: "Clear {:d}".format(len(self._routes)), self.clear),
+        ))
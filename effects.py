@@ -0,0 +1,120 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Effects chain which removes idle stages from the audio path
+
+import asyncio
+import time
+import synthio
+import audiomixer
+
+import settings
+
+QUIET = 2.0 # Time without pressed notes before idle stages are removed (seconds)
+INTERVAL = 0.25 # Time between checks for idle stages (seconds)
+
+class Stage:
+    def __init__(self, title:str, effect:object, blocks:tuple = tuple()):
+        self.title = title
+        self.effect = effect
+        self.blocks = blocks
+        self.active = False
+        self.source = None
+
+    @property
+    def idle(self) -> bool:
+        mix = self.effect.mix
+        return type(mix) is float and mix <= 0.0
+
+class Chain:
+    """Connects a synthesizer to a mixer voice through a series of effects. A stage with a mix of
+    zero is bypassed by its own mix, which leaves its output fully dry, and is only removed from the
+    chain along with its modulation blocks once no notes have been pressed for :const:`QUIET`
+    seconds. A stage is inserted back as soon as its mix is raised. Only the connections around a
+    changed stage are replaced, since playing a source resets its buffers, so the remaining stages
+    keep their echo tails.
+
+    The audio chain is rendered in the background by the audio driver, so the processing time of each
+    stage can't be measured from Python. The menu shows which stages are active instead.
+    """
+
+    def __init__(self, synthesizer:synthio.Synthesizer, voice:audiomixer.MixerVoice):
+        self._synthesizer = synthesizer
+        self._voice = voice
+        self._source = None
+        self._stages = []
+        self._pressed = None
+
+    @property
+    def stages(self) -> tuple[Stage]:
+        return tuple(self._stages)
+
+    @property
+    def active_stages(self) -> tuple[Stage]:
+        return tuple(filter(lambda stage: stage.active, self._stages))
+
+    @property
+    def quiet(self) -> bool:
+        if self._synthesizer.pressed:
+            self._pressed = time.monotonic()
+        return self._pressed is None or time.monotonic() - self._pressed >= QUIET
+
+    def append(self, title:str, effect:object, blocks:tuple = tuple()) -> Stage:
+        stage = Stage(title, effect, blocks)
+        self._stages.append(stage)
+        return stage
+
+    def find(self, effect:object) -> Stage|None:
+        for stage in self._stages:
+            if stage.effect is effect:
+                return stage
+        return None
+
+    def set_attribute(self, effect:object, name:str, value:any) -> None:
+        stage = self.find(effect)
+        if stage is not None and name == 'mix' and value > 0.0 and not stage.active:
+            # Insert stage while dry before applying the new mix level
+            stage.active = True
+            self._build()
+        setattr(effect, name, value)
+
+    def update(self) -> None:
+        changed = False
+        quiet = self.quiet
+        for stage in self._stages:
+            if stage.active == stage.idle and (quiet or not stage.active):
+                stage.active = not stage.active
+                changed = True
+        if changed or self._source is None:
+            self._build()
+
+    async def task(self) -> None:
+        while True:
+            self.update()
+            await asyncio.sleep(INTERVAL)
+
+    def _build(self) -> None:
+        source = self._synthesizer
+        for stage in self._stages:
+            for block in stage.blocks:
+                if stage.active and block not in self._synthesizer.blocks:
+                    self._synthesizer.blocks.append(block)
+                elif not stage.active and block in self._synthesizer.blocks:
+                    self._synthesizer.blocks.remove(block)
+            if stage.active:
+                if stage.source is not source:
+                    stage.effect.play(source)
+                    stage.source = source
+                source = stage.effect
+            elif stage.source is not None:
+                stage.effect.stop()
+                stage.source = None
+        if self._source is not source:
+            self._voice.play(source)
+            self._source = source
+        if settings.performance_telemetry:
+            print("effects: {:s}".format(str(self)))
+
+    def __str__(self) -> str:
+        return ">".join(["Syn"] + [stage.title[:3] for stage in self.active_stages])
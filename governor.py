@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Polyphony governor which adjusts the number of voices to the available processing headroom
+
+import asyncio
+import synthkeyboard
+
+import settings
+import telemetry
+
+class Governor:
+    """Reads how late the event loop wakes from each sleep as measured by :mod:`telemetry`, which
+    increases as audio rendering takes up more of the processor, and adjusts the maximum voices of a
+    keyboard to match. Voices are removed as soon as the lag passes the upper threshold and are only
+    restored after the lag has remained under the lower threshold for a number of consecutive
+    intervals.
+
+    The lag only counts the shortest wakeup within each window of iterations, so menu, display and
+    storage work which blocks the loop for a few iterations doesn't remove voices. The number of
+    oscillators per voice is never changed, since that would alter the sound of a patch.
+    """
+
+    def __init__(self, keyboard:synthkeyboard.Keyboard, maximum:int, minimum:int = 1, interval:float = 0.5, upper:float = 0.004, lower:float = 0.0015, hold:int = 4):
+        self._keyboard = keyboard
+        self._maximum = maximum
+        self._minimum = minimum
+        self._interval = interval
+        self._upper = upper
+        self._lower = lower
+        self._hold = hold
+        self._voices = maximum
+        self._count = 0
+        self.active = True
+
+    @property
+    def voices(self) -> int:
+        return self._voices
+
+    @property
+    def maximum(self) -> int:
+        return self._maximum
+
+    @property
+    def lag(self) -> float:
+        return telemetry.lag
+
+    def _set_voices(self, value:int, reason:str) -> None:
+        value = min(max(value, self._minimum), self._maximum)
+        if value == self._voices:
+            return
+        if settings.performance_telemetry:
+            print("governor: lag={:.2f}ms voices={:d}->{:d} ({:s})".format(telemetry.lag * 1000, self._voices, value, reason))
+        self._voices = value
+        if self.active:
+            self._keyboard.max_voices = value
+
+    def _evaluate(self) -> None:
+        if not settings.performance_governor:
+            self._count = 0
+            self._set_voices(self._maximum, "disabled")
+        elif telemetry.lag > self._upper:
+            self._count = 0
+            self._set_voices(self._voices - 1, "overload")
+        elif telemetry.lag < self._lower:
+            self._count += 1
+            if self._count >= self._hold:
+                self._count = 0
+                self._set_voices(self._voices + 1, "headroom")
+        else:
+            self._count = 0
+
+    async def update(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            self._evaluate()
@@ -0,0 +1,69 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Multisample key and velocity zone maps
+#
+# A map file is a JSON list of zones within the sample directory, ie:
+# [
+#     {"file": "piano-c3.wav", "low": 0, "high": 54, "root": 48},
+#     {"file": "piano-c4.wav", "low": 55, "high": 66, "root": 60, "velocity": [0, 95]},
+#     {"file": "piano-c4-hard.wav", "low": 55, "high": 66, "root": 60, "velocity": [96, 127]},
+#     {"file": "piano-c5.wav", "low": 67, "high": 127}
+# ]
+# The root note and fine tune of a zone are detected if not provided.
+
+import json
+
+class Zone:
+    def __init__(self, path:str, low:int = 0, high:int = 127, root:int = None, tune:float = 0.0, velocity:tuple = (0, 127)):
+        self.path = path
+        self.low = low
+        self.high = high
+        self.root = root
+        self.tune = tune
+        self.velocity = velocity
+
+class Keymap:
+    """Set of zones which each cover a range of notes and velocities with a separate sample. The
+    velocity boundaries of all zones divide velocity into layers, and zones are resolved through a
+    table indexed by note and layer so that finding the zone of a note costs a single lookup. Samples
+    aren't read until a note within their zone is first played.
+    """
+
+    def __init__(self, path:str, directory:str):
+        self.path = path
+        with open(path, "r") as file:
+            data = json.load(file)
+        self.zones = tuple([
+            Zone(
+                path=directory + "/" + zone["file"],
+                low=zone.get("low", 0),
+                high=zone.get("high", 127),
+                root=zone.get("root", None),
+                tune=zone.get("tune", 0.0),
+                velocity=tuple(zone.get("velocity", (0, 127))),
+            ) for zone in data
+        ])
+
+        # Each layer starts at a zone boundary, so every zone covers whole layers
+        starts = sorted(set([0] + [
+            value for zone in self.zones for value in (zone.velocity[0], zone.velocity[1] + 1) if 0 < value < 128
+        ]))
+        self._layers = bytearray(128)
+        for layer, start in enumerate(starts):
+            for velocity in range(start, 128):
+                self._layers[velocity] = layer
+        self._count = len(starts)
+
+        # Earlier zones take priority where zones overlap
+        self._table = [None] * (128 * self._count)
+        for zone in reversed(self.zones):
+            for layer, start in enumerate(starts):
+                if zone.velocity[0] <= start <= zone.velocity[1]:
+                    for notenum in range(max(zone.low, 0), min(zone.high, 127) + 1):
+                        self._table[notenum * self._count + layer] = zone
+
+    def get(self, notenum:int, velocity:float = 1.0) -> Zone|None:
+        """Get the zone of a note with a velocity of 0.0-1.0."""
+        return self._table[(notenum & 0x7f) * self._count + self._layers[min(int(velocity * 127), 127)]]
@@ -0,0 +1,152 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Shared modulation LFOs which can be bound to multiple voices in place of their own
+
+import synthio
+from micropython import const
+
+class Mode:
+    VOICE = const(0)
+    GLOBAL = const(1)
+
+# Note properties which may hold blocks
+PROPERTIES = ('amplitude', 'bend', 'panning', 'ring_bend', 'waveform_loop_start', 'waveform_loop_end')
+
+def _collect(value:object, blocks:list) -> None:
+    if not isinstance(value, (synthio.LFO, synthio.Math)):
+        return
+    for block in blocks:
+        if block is value:
+            return
+    blocks.append(value)
+    for name in (('a', 'b', 'c') if isinstance(value, synthio.Math) else ('rate', 'scale', 'offset', 'phase_offset')):
+        _collect(getattr(value, name, None), blocks)
+
+def get_block_count(synthesizer:synthio.Synthesizer, notes:list|tuple) -> int:
+    """Count the distinct blocks evaluated by a synthesizer while the notes are playing, including
+    blocks attached to the notes and their inputs rather than only those within `synthesizer.blocks`.
+    """
+    blocks = []
+    for block in synthesizer.blocks:
+        _collect(block, blocks)
+    for note in notes:
+        for name in PROPERTIES:
+            _collect(getattr(note, name, None), blocks)
+    return len(blocks)
+
+class GlobalLFO:
+    """A single set of tremolo, vibrato and panning LFO blocks shared by a group of voices. While
+    active, the blocks are evaluated once per audio buffer by the synthesizer and replace the LFOs of
+    each voice's notes as they are pressed, so that the LFOs of the voices are no longer evaluated.
+    The LFOs of the voices are restored when unbound.
+    """
+
+    def __init__(self, synthesizer:synthio.Synthesizer):
+        self._synthesizer = synthesizer
+        self._tremolo = synthio.LFO(rate=1.0, scale=0.0, offset=1.0)
+        self._vibrato = synthio.LFO(rate=1.0, scale=0.0, offset=0.0)
+        self._pan = synthio.LFO(rate=1.0, scale=0.0, offset=0.0)
+        self._bindings = {}
+        self._active = False
+
+    @property
+    def blocks(self) -> tuple[synthio.LFO]:
+        return (self._tremolo, self._vibrato, self._pan)
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    @active.setter
+    def active(self, value:bool) -> None:
+        if value == self._active:
+            return
+        self._active = value
+        for block in self.blocks:
+            if value:
+                self._synthesizer.blocks.append(block)
+            elif block in self._synthesizer.blocks:
+                self._synthesizer.blocks.remove(block)
+        if not value:
+            self.unbind()
+
+    def bind(self, voice:object) -> None:
+        if not self._active:
+            return
+        for note in voice.notes:
+            binding = self._bindings.get(note)
+            if binding is None:
+                binding = self._bindings[note] = [None, None, None]
+            binding[0] = self._detach(note, 'amplitude', binding[0], synthio.MathOperation.PRODUCT, self._tremolo, 1.0)
+            binding[1] = self._detach(note, 'bend', binding[1], synthio.MathOperation.SUM, self._vibrato, 0.0)
+            binding[2] = self._detach(note, 'panning', binding[2], synthio.MathOperation.SUM, self._pan, 0.0)
+
+    def _detach(self, note:synthio.Note, name:str, binding:tuple|None, operation:synthio.MathOperation, block:synthio.LFO, identity:float) -> tuple:
+        value = getattr(note, name)
+        if binding is not None and value is binding[1]:
+            return binding
+        # The LFO of the voice is replaced by its resting value so that it is no longer evaluated
+        rest = value.offset if isinstance(value, synthio.LFO) else value
+        if rest == identity:
+            replacement = block
+        else:
+            replacement = synthio.Math(operation, block, rest, identity)
+        setattr(note, name, replacement)
+        return (value, replacement)
+
+    def unbind(self) -> None:
+        for note, binding in self._bindings.items():
+            for name, item in zip(('amplitude', 'bend', 'panning'), binding):
+                if item is not None and getattr(note, name) is item[1]:
+                    setattr(note, name, item[0])
+        self._bindings = {}
+
+    @property
+    def tremolo_depth(self) -> float:
+        return self._tremolo.scale
+
+    @tremolo_depth.setter
+    def tremolo_depth(self, value:float) -> None:
+        self._tremolo.scale = value
+
+    @property
+    def tremolo_rate(self) -> float:
+        return self._tremolo.rate
+
+    @tremolo_rate.setter
+    def tremolo_rate(self, value:float) -> None:
+        self._tremolo.rate = value
+
+    @property
+    def vibrato_depth(self) -> float:
+        return self._vibrato.scale
+
+    @vibrato_depth.setter
+    def vibrato_depth(self, value:float) -> None:
+        self._vibrato.scale = value
+
+    @property
+    def vibrato_rate(self) -> float:
+        return self._vibrato.rate
+
+    @vibrato_rate.setter
+    def vibrato_rate(self, value:float) -> None:
+        self._vibrato.rate = value
+
+    @property
+    def pan_depth(self) -> float:
+        return self._pan.scale
+
+    @pan_depth.setter
+    def pan_depth(self, value:float) -> None:
+        self._pan.scale = value
+
+    @property
+    def pan_rate(self) -> float:
+        return self._pan.rate
+
+    @pan_rate.setter
+    def pan_rate(self, value:float) -> None:
+        self._pan.rate = value
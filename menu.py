@@ -5,10 +5,12 @@
 import time
 import os
 import gc
+import json
 import supervisor
 import synthmenu
 import synthkeyboard
 import hardware
+import telemetry
 
 DELAY = 0.5
 APP_DIR = "/apps"
@@ -47,9 +49,14 @@ def write_message(msg:str, delay:bool|float = False) -> None:
     if delay:
         time.sleep(delay if type(delay) is float else DELAY)
 
-def load_patch(menu:synthmenu.Menu, item:synthmenu.Item, value:int, prepend:str = 'patch') -> bool:
-    on_update = item.on_update
-    item.on_update = None
+PATCHES = 16
+
+# RAM-resident preset banks of each app, indexed by patch prefix. Patches are kept as their JSON text,
+# which is far smaller than the parsed dictionaries, and only parsed when loaded.
+_patches = {}
+_UNLOADED = False
+
+def get_patch_path(value:int, prepend:str = 'patch') -> str:
     path = "/presets/{:s}-{:d}.json".format(prepend, value)
     try:
         os.stat("/sd/presets")
@@ -57,29 +64,90 @@ def load_patch(menu:synthmenu.Menu, item:synthmenu.Item, value:int, prepend:str
         pass
     else:
         path = "/sd" + path
-    result = menu.read(path)
-    if not result:
+    return path
+
+def _is_resident(value:int, prepend:str) -> bool:
+    return prepend in _patches and 0 <= value < len(_patches[prepend])
+
+def _store_patch(value:int, prepend:str, data:any) -> None:
+    if _is_resident(value, prepend):
+        _patches[prepend][value] = json.dumps(data) if data is not None else None
+
+def read_patch(value:int, prepend:str = 'patch') -> dict|None:
+    if _is_resident(value, prepend) and (text := _patches[prepend][value]) is not _UNLOADED:
+        return json.loads(text) if text is not None else None
+    try:
+        with open(get_patch_path(value, prepend), "r") as file:
+            text = file.read()
+        data = json.loads(text)
+    except (OSError, ValueError):
+        text = data = None
+    if _is_resident(value, prepend):
+        _patches[prepend][value] = text
+    return data
+
+def load_patches(prepend:str = 'patch', count:int = PATCHES, lazy:bool = False) -> None:
+    _patches[prepend] = [_UNLOADED] * count
+    if not lazy:
+        for i in range(count):
+            read_patch(i, prepend)
+
+def get_items(group:synthmenu.Group) -> list[synthmenu.Item]:
+    # Items are returned in menu order, composite items such as envelopes are treated as a single unit
+    items = []
+    for i in range(len(group)):
+        item = group[i]
+        if type(item) is synthmenu.Group:
+            items.extend(get_items(item))
+        else:
+            items.append(item)
+    return items
+
+def apply_data(menu:synthmenu.Menu, data:dict|None) -> int:
+    """Set the data of the menu and fire the update callbacks of only the items that have changed in
+    menu order. Returns the number of updated items.
+    """
+    items = get_items(menu)
+    previous = [item.data for item in items]
+    if data is None:
         menu.reset(True)
-    menu.do_update()
+    else:
+        menu.data = data
+    count = 0
+    for i, item in enumerate(items):
+        if item.data != previous[i]:
+            item.do_update()
+            count += 1
+    return count
+
+def load_patch(menu:synthmenu.Menu, item:synthmenu.Item, value:int, prepend:str = 'patch') -> bool:
+    start = time.monotonic_ns()
+    on_update = item.on_update
+    item.on_update = None
+    count = apply_data(menu, (data := read_patch(value, prepend)))
     item.data = value
     item.on_update = on_update
-    return result
+    telemetry.record_patch(value, count, (time.monotonic_ns() - start) / 1000000)
+    return data is not None
 
 def save_patch(menu:synthmenu.Menu, value:int, prepend:str = 'patch') -> bool:
     write_message("Saving...")
-    path = "/presets/{:s}-{:d}.json".format(prepend, value)
-    try:
-        os.stat("/sd/presets")
-    except OSError:
-        pass
-    else:
-        path = "/sd" + path
-    if (result := menu.write(path)):
+    if (result := menu.write(get_patch_path(value, prepend))):
+        _store_patch(value, prepend, menu.data)
         write_message("Complete!", True)
     else:
         write_message("Failed!", True)
     return result
 
+def write_patch(data:any, value:int, prepend:str = 'patch') -> bool:
+    try:
+        with open(get_patch_path(value, prepend), "w") as file:
+            json.dump(data, file)
+    except OSError:
+        return False
+    _store_patch(value, prepend, data)
+    return True
+
 def copy_data(source:str|synthmenu.Group, target:str|synthmenu.Group|list[str|synthmenu.Group], menu:synthmenu.Menu = None) -> None:
     write_message("Copying...")
 
@@ -0,0 +1,195 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Shared handling of incoming USB and hardware MIDI messages
+
+import asyncio
+import time
+import audiomixer
+import synthkeyboard
+import usb_midi
+
+from adafruit_midi.midi_message import MIDIMessage
+
+import hardware
+import menu
+import settings
+import telemetry
+from midiport import NOTE_OFF, NOTE_ON, CONTROL_CHANGE, PITCH_BEND, Filter, Port
+
+# Port of the message currently being dispatched, if any
+source = None
+
+def get_filter() -> int:
+    """Get the message type mask from the MIDI settings."""
+    mask = Filter.ALL
+    if not settings.midi_notes:
+        mask &= ~(Filter.NOTE_OFF | Filter.NOTE_ON)
+    if not settings.midi_control:
+        mask &= ~Filter.CONTROL_CHANGE
+    if not settings.midi_bend:
+        mask &= ~Filter.PITCH_BEND
+    if not settings.midi_pressure:
+        mask &= ~(Filter.POLYPHONIC_PRESSURE | Filter.CHANNEL_PRESSURE)
+    if not settings.midi_program:
+        mask &= ~Filter.PROGRAM_CHANGE
+    if not settings.midi_system:
+        mask &= ~Filter.SYSTEM
+    return mask
+
+_ports = None
+
+def get_ports() -> tuple[Port]:
+    """Get the USB and hardware ports, which forward to each other when thru is enabled. Must be
+    called after :func:`hardware.init`.
+    """
+    global _ports
+    if _ports is None:
+        ports = []
+        if hardware.midi_usb is not None:
+            ports.append(Port(usb_midi.ports[0], usb_midi.ports[1]))
+        ports.append(Port(hardware.uart, hardware.uart, baudrate=hardware.uart.baudrate))
+        for port in ports:
+            port.latency = telemetry.Histogram()
+        _ports = tuple(ports)
+    return _ports
+
+_revision = None
+
+def update_ports() -> None:
+    """Apply the channel, filter and thru settings to each port whenever they have changed. When thru
+    is enabled, the USB and hardware ports forward to each other.
+    """
+    global _revision
+    if _revision == settings.revision:
+        return
+    _revision = settings.revision
+    ports = get_ports()
+    mask = get_filter()
+    for i, port in enumerate(ports):
+        port.channel = settings.midi_channel
+        port.out_channel = settings.midi_channel - 1 if settings.midi_channel else 0
+        port.mask = mask
+        port.set_thru(ports[1 - i] if settings.midi_thru and len(ports) > 1 else None)
+
+def get_timestamp() -> int|None:
+    """Get the read time (ns) of the message currently being dispatched, if any."""
+    return source.timestamp if source is not None else None
+
+def record_press() -> None:
+    """Record the time between the message currently being dispatched being read and a voice being
+    pressed. Should be called within the voice press callback of the app's keyboard.
+    """
+    if source is not None and source.timestamp is not None:
+        source.latency.append((time.monotonic_ns() - source.timestamp) / 1000000)
+
+def send(msg:MIDIMessage|bytes) -> None:
+    for port in get_ports():
+        port.send(msg)
+
+def flush() -> None:
+    """Send the output queue of each port as far as the rate of each interface allows."""
+    for port in get_ports():
+        port.flush()
+
+async def update() -> None:
+    """Drain the output queue of each port."""
+    while True:
+        update_ports()
+        flush()
+        await asyncio.sleep(hardware.TASK_SLEEP)
+
+class Router:
+    """Dispatches incoming messages with a table of handlers by status nibble, a table of system
+    message handlers by status byte and a table of control change handlers by control number. The
+    tables are populated once by the app so that each message only costs a single lookup.
+    """
+
+    def __init__(self, budget:float = None):
+        self._budget = int((budget if budget is not None else hardware.TASK_SLEEP) * 1000000000)
+        self._cost = 100000 # Estimated processing time per message (ns)
+        self._handlers = [None] * 16
+        self._system = [None] * 16
+        self._controls = [None] * 128
+        self._handlers[CONTROL_CHANGE >> 4] = self._control_change
+        self._handlers[0x0f] = self._system_message
+
+    def set_handler(self, status:int, callback:callable) -> None:
+        """Assign a callback which receives `(status, data1, data2)` for a channel message type (ie:
+        :const:`NOTE_ON`) or a system message (ie: :const:`TIMING_CLOCK`).
+        """
+        if status >= 0xf0:
+            self._system[status & 0x0f] = callback
+        else:
+            self._handlers[status >> 4] = callback
+
+    def get_handler(self, status:int) -> callable:
+        if status >= 0xf0:
+            return self._system[status & 0x0f]
+        return self._handlers[status >> 4]
+
+    def set_control(self, control:int, callback:callable) -> None:
+        """Assign a callback which receives the value (0-127) of a control change number."""
+        self._controls[control & 0x7f] = callback
+
+    def _control_change(self, status:int, control:int, value:int) -> None:
+        if (callback := self._controls[control]) is not None:
+            callback(value)
+
+    def _system_message(self, status:int, data1:int, data2:int) -> None:
+        if (callback := self._system[status & 0x0f]) is not None:
+            callback(status, data1, data2)
+
+    def process_message(self, status:int, data1:int, data2:int) -> None:
+        if (handler := self._handlers[status >> 4]) is not None:
+            handler(status, data1, data2)
+
+    async def update(self) -> None:
+        global source
+        ports = get_ports()
+        while True:
+            update_ports()
+            backlog = 0
+            for port in ports:
+                port.read()
+                backlog += port.backlog
+
+            if backlog:
+                # Only dispatch is timed, since reading may wait on the interface
+                start = time.monotonic_ns()
+                # Share the messages which fit within the time budget between ports by backlog
+                capacity = max(self._budget // self._cost, len(ports))
+                overload = backlog > capacity * 2 # At least 2 bytes per message with running status
+                count = 0
+                for port in ports:
+                    if port.backlog:
+                        source = port
+                        count += port.receive(self.process_message, max(capacity * port.backlog // backlog, 1), overload)
+                source = None
+                if count:
+                    self._cost += ((time.monotonic_ns() - start) // count - self._cost) // 4
+
+            await asyncio.sleep(hardware.TASK_SLEEP)
+
+def get_router(keyboard:synthkeyboard.Keyboard, mixer:audiomixer.Mixer, voices:list|tuple) -> Router:
+    """Create a router with the note, pitch bend and standard control change handling of a keyboard
+    based app.
+    """
+    router = Router()
+
+    def note_on(status:int, notenum:int, velocity:int) -> None:
+        if velocity > 0:
+            keyboard.append(notenum, velocity)
+        else:
+            keyboard.remove(notenum)
+    router.set_handler(NOTE_ON, note_on)
+    router.set_handler(NOTE_OFF, lambda status, notenum, velocity: keyboard.remove(notenum))
+    router.set_handler(PITCH_BEND, lambda status, lsb, msb: menu.set_attribute(voices, 'bend', ((msb << 7 | lsb) - 8192) / 8192))
+
+    router.set_control(7, lambda value: menu.set_attribute(mixer.voice[0], 'level', value / 127)) # Volume
+    router.set_control(10, lambda value: menu.set_attribute(voices, 'pan', value / 64 - 1)) # Pan
+    router.set_control(11, lambda value: menu.set_attribute(voices, 'velocity_amount', value / 127)) # Expression
+    router.set_control(64, lambda value: menu.set_attribute(keyboard, 'sustain', value >= 64)) # Sustain
+
+    return router
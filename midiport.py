@@ -0,0 +1,442 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Byte level MIDI input parsing and output queueing of a single port
+#
+# Usage on host: python3 midiport.py [-n MESSAGES] [-l LIMIT]
+
+import time
+
+try:
+    from micropython import const
+except ImportError:
+    const = lambda value: value
+
+NOTE_OFF = const(0x80)
+NOTE_ON = const(0x90)
+POLYPHONIC_PRESSURE = const(0xa0)
+CONTROL_CHANGE = const(0xb0)
+PROGRAM_CHANGE = const(0xc0)
+CHANNEL_PRESSURE = const(0xd0)
+PITCH_BEND = const(0xe0)
+SYSTEM_EXCLUSIVE = const(0xf0)
+SYSTEM_EXCLUSIVE_END = const(0xf7)
+TIMING_CLOCK = const(0xf8)
+START = const(0xfa)
+CONTINUE = const(0xfb)
+STOP = const(0xfc)
+
+INTERVAL = 0.25 # Longest time between flushes over which the output allowance of a port accumulates (s)
+SYSEX_QUEUE = 4 # System exclusive messages which can be held back at once
+
+class Filter:
+    """Message type mask bits, one per status nibble (0x8-0xF)."""
+    NOTE_OFF = const(0x01)
+    NOTE_ON = const(0x02)
+    POLYPHONIC_PRESSURE = const(0x04)
+    CONTROL_CHANGE = const(0x08)
+    PROGRAM_CHANGE = const(0x10)
+    CHANNEL_PRESSURE = const(0x20)
+    PITCH_BEND = const(0x40)
+    SYSTEM = const(0x80)
+    ALL = const(0xff)
+
+# Number of data bytes of channel messages by status nibble (0x8-0xE)
+_DATA_LENGTH = (2, 2, 2, 2, 1, 1, 2)
+
+def get_data_length(status:int) -> int:
+    if status < 0xf0:
+        return _DATA_LENGTH[(status >> 4) - 8]
+    elif status == 0xf1 or status == 0xf3:
+        return 1
+    elif status == 0xf2:
+        return 2
+    return 0
+
+class Port:
+    """The raw input and output streams of a MIDI interface. Incoming bytes can be forwarded directly
+    to the output of another port (thru) as soon as they are read, without being parsed into messages.
+    The destination only tracks message boundaries so that running status is restored and messages
+    sent by the app are held back while a forwarded message or system exclusive is incomplete.
+
+    Outgoing messages are placed in a ring buffer which is drained by :func:`update` at the rate of the
+    interface rather than blocking the caller. Continuous controller, pressure and pitch bend messages
+    which replace one still waiting in the queue are merged, and running status is used wherever
+    possible to reduce the number of bytes sent. System exclusive messages are held separately and
+    sent in order once the messages queued before them have been sent. Only realtime messages are
+    written immediately.
+
+    Input is parsed at the byte level. The channel and message type filters are applied as soon as a
+    status byte is read so that the data of rejected messages is skipped without being decoded. When
+    overloaded, continuous controller, pressure and pitch bend messages are held back and coalesced to
+    their latest value so that notes are handled first.
+
+    The settings of the app are applied by :mod:`midi` through :meth:`set_thru` and the
+    :attr:`channel` and :attr:`mask` attributes so that the port can also be run on the host.
+    """
+
+    def __init__(self, midi_in:object, midi_out:object, buffer_size:int = 128, queue_size:int = 64, baudrate:int = None):
+        self._in = midi_in
+        self._out = midi_out
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self.thru = None
+        self.channel = None # Accepted input channel (1-16), or all channels if None
+        self.out_channel = 0 # Channel (0-15) of sent messages which don't specify one
+        self.mask = Filter.ALL # Accepted message types
+        self.timestamp = None # Read time (ns) of the message currently being dispatched
+        self.latency = None
+
+        # Input state
+        self._in_status = 0
+        self._in_remaining = 0
+        self._in_accept = False
+        self._in_data = 0
+        self._in_waiting = hasattr(midi_in, 'in_waiting')
+        self._deferred = {}
+        self._reads = []
+        self._filtered = 0
+        self.received = 0
+        self.coalesced = 0
+        self.max_backlog = 0
+
+        # Output state
+        self._status = 0
+        self._thru_status = 0
+        self._thru_remaining = 0
+        self._thru_sysex = False
+        self._queue = bytearray(queue_size * 3)
+        self._queue_size = queue_size
+        self._head = 0
+        self._count = 0
+        self._sysex = [] # [messages queued ahead, data]
+        self._rate = baudrate / 10 if baudrate else None # bytes per second
+        self._credit = 0.0
+        self._last = time.monotonic_ns()
+        self.max_depth = 0
+        self.dropped = 0
+        self.merged = 0
+
+    @property
+    def filtered(self) -> int:
+        """The number of messages rejected by the channel and type filters."""
+        return self._filtered
+
+    @property
+    def busy(self) -> bool:
+        return self._thru_sysex or self._thru_remaining > 0
+
+    def set_thru(self, port:object) -> None:
+        """Forward all input to the output of another port, or stop forwarding if None."""
+        if port is self.thru:
+            return
+        if self.thru is not None:
+            self.thru.reset_thru()
+        self.thru = port
+
+    def reset_thru(self) -> None:
+        """Clear the state of a forwarded stream which has been interrupted."""
+        self._thru_status, self._thru_remaining, self._thru_sysex = 0, 0, False
+
+    def write(self, data:bytes) -> None:
+        if self._out is not None:
+            self._out.write(data)
+
+    @property
+    def depth(self) -> int:
+        """The number of messages waiting in the output queue."""
+        return self._count + len(self._sysex)
+
+    def send(self, msg:object) -> None:
+        if getattr(msg, 'channel', 0) is None:
+            msg.channel = self.out_channel
+            data = bytes(msg)
+            msg.channel = None
+        else:
+            data = bytes(msg)
+        if not data:
+            return
+        status = data[0]
+
+        if status >= 0xf8: # Realtime messages may be sent at any time
+            self.write(data)
+            return
+        elif status == SYSTEM_EXCLUSIVE or len(data) > 3:
+            if len(self._sysex) >= SYSEX_QUEUE:
+                self.dropped += 1
+                return
+            self._sysex.append([self._count, data])
+            if self.depth > self.max_depth:
+                self.max_depth = self.depth
+            return
+
+        queue = self._queue
+        if status < 0xf0 and (status & 0xf0) in (POLYPHONIC_PRESSURE, CONTROL_CHANGE, CHANNEL_PRESSURE, PITCH_BEND):
+            # Merge with a matching message at the end of the queue which hasn't been sent yet and isn't
+            # ahead of a held back system exclusive
+            for i in range(self._count - 1, self._sysex[-1][0] - 1 if self._sysex else -1, -1):
+                j = ((self._head + i) % self._queue_size) * 3
+                if queue[j] & 0xf0 not in (POLYPHONIC_PRESSURE, CONTROL_CHANGE, CHANNEL_PRESSURE, PITCH_BEND):
+                    break
+                if queue[j] == status and ((status & 0xf0) in (CHANNEL_PRESSURE, PITCH_BEND) or queue[j + 1] == data[1]):
+                    queue[j + 1:j + len(data)] = data[1:]
+                    self.merged += 1
+                    return
+
+        if self._count >= self._queue_size:
+            self.dropped += 1
+            return
+        j = ((self._head + self._count) % self._queue_size) * 3
+        queue[j:j + len(data)] = data
+        self._count += 1
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+
+    def flush(self) -> None:
+        now = time.monotonic_ns()
+        if self._rate is not None:
+            self._credit = min(self._credit + (now - self._last) * self._rate / 1000000000, self._rate * INTERVAL)
+        self._last = now
+        if not self.depth or self.busy:
+            return
+
+        queue = self._queue
+        data = bytearray()
+        while self.depth:
+            if self._sysex and not self._sysex[0][0]:
+                message = self._sysex[0][1]
+                if self._rate is not None and data and len(data) + len(message) > self._credit:
+                    break
+                data.extend(message)
+                self._status = 0
+                self._sysex.pop(0)
+                continue
+            j = self._head * 3
+            status = queue[j]
+            length = get_data_length(status)
+            running = status == self._status and status < 0xf0
+            if self._rate is not None and data and len(data) + length + (0 if running else 1) > self._credit:
+                break
+            if not running:
+                data.append(status)
+            data.extend(queue[j + 1:j + 1 + length])
+            self._status = status if status < 0xf0 else 0
+            self._head = (self._head + 1) % self._queue_size
+            self._count -= 1
+            for sysex in self._sysex:
+                sysex[0] -= 1
+        if self._rate is not None:
+            self._credit = max(self._credit - len(data), 0.0)
+        self.write(data)
+
+    def forward(self, data:bytes) -> None:
+        # Restore running status of forwarded stream if interrupted by another message
+        if data[0] < 0x80 and not self.busy and self._thru_status and self._status != self._thru_status:
+            self.write(bytes((self._thru_status,)))
+        self.write(data)
+
+        status, remaining, sysex = self._thru_status, self._thru_remaining, self._thru_sysex
+        for byte in data:
+            if byte >= 0xf8: # Realtime
+                continue
+            elif byte >= 0x80:
+                sysex = byte == SYSTEM_EXCLUSIVE
+                status = byte if byte < 0xf0 else 0
+                remaining = get_data_length(byte)
+            elif not sysex:
+                if not remaining and status:
+                    remaining = get_data_length(status)
+                if remaining:
+                    remaining -= 1
+        self._thru_status, self._thru_remaining, self._thru_sysex = status, remaining, sysex
+        self._status = status
+
+    @property
+    def backlog(self) -> int:
+        """The number of input bytes waiting to be processed."""
+        backlog = len(self._buffer)
+        if self._in_waiting:
+            backlog += self._in.in_waiting
+        return backlog
+
+    def read(self) -> None:
+        """Read the input waiting to be processed which fits within the buffer. Must be called before
+        :meth:`receive`.
+        """
+        if self._in is None or (size := self._buffer_size - len(self._buffer)) <= 0:
+            return
+        if self._in_waiting and (size := min(size, self._in.in_waiting)) <= 0:
+            return
+        data = self._in.read(size)
+        if data:
+            if self.thru is not None:
+                self.thru.forward(data)
+            self._buffer.extend(data)
+            self._reads.append([len(self._buffer), time.monotonic_ns()])
+        if (backlog := self.backlog) > self.max_backlog:
+            self.max_backlog = backlog
+
+    def _get_timestamp(self, index:int) -> int|None:
+        for read in self._reads:
+            if index <= read[0]:
+                return read[1]
+        return None
+
+    def receive(self, callback:callable, limit:int = 32, overload:bool = False) -> int:
+        """Parse input buffered by :meth:`read` and pass up to `limit` accepted messages to `callback` as `(status,
+        data1, data2)`. Returns the number of messages passed. The read time of each message is
+        available from :attr:`timestamp` during the callback.
+        """
+        deferred = self._deferred
+        buffer = self._buffer
+        channel = self.channel
+        mask = self.mask
+        status, remaining, accept, data = self._in_status, self._in_remaining, self._in_accept, self._in_data
+        count = 0
+        index = 0
+        while index < len(buffer) and count < limit:
+            byte = buffer[index]
+            index += 1
+
+            if byte >= 0xf8: # Realtime messages may occur anywhere and don't affect running status
+                if mask & Filter.SYSTEM:
+                    self.timestamp = self._get_timestamp(index)
+                    callback(byte, 0, 0)
+                    count += 1
+                else:
+                    self._filtered += 1
+                continue
+
+            if byte == SYSTEM_EXCLUSIVE_END:
+                status = 0
+                continue
+
+            if byte >= 0x80:
+                status = byte
+                remaining = get_data_length(byte)
+                if byte >= 0xf0:
+                    accept = bool(mask & Filter.SYSTEM) and byte != SYSTEM_EXCLUSIVE
+                else:
+                    accept = bool(mask & (1 << ((byte >> 4) - 8))) and (channel is None or (byte & 0x0f) + 1 == channel)
+                if not accept:
+                    self._filtered += 1
+                elif not remaining and byte >= 0xf0:
+                    self.timestamp = self._get_timestamp(index)
+                    callback(byte, 0, 0)
+                    count += 1
+                    status = 0
+                continue
+
+            if not status or status == SYSTEM_EXCLUSIVE: # Stray data or system exclusive
+                continue
+            if not remaining: # Running status
+                remaining = get_data_length(status)
+                if not accept:
+                    self._filtered += 1
+            remaining -= 1
+            if not accept:
+                continue
+            if remaining:
+                data = byte
+                continue
+
+            if get_data_length(status) == 1:
+                data, byte = byte, 0
+
+            if overload and status < 0xf0 and (status & 0xf0) in (POLYPHONIC_PRESSURE, CONTROL_CHANGE, CHANNEL_PRESSURE, PITCH_BEND) and not ((status & 0xf0) == CONTROL_CHANGE and 64 <= data <= 69):
+                key = status << 8 | (data if (status & 0xf0) in (POLYPHONIC_PRESSURE, CONTROL_CHANGE) else 0)
+                if key in deferred:
+                    self.coalesced += 1
+                deferred[key] = (status, data, byte, self._get_timestamp(index))
+                continue
+
+            self.timestamp = self._get_timestamp(index)
+            callback(status, data, byte)
+            count += 1
+            if status >= 0xf0:
+                status = 0
+
+        if index:
+            self._buffer = buffer[index:]
+            for read in self._reads:
+                read[0] -= index
+            self._reads = [read for read in self._reads if read[0] > 0]
+        self._in_status, self._in_remaining, self._in_accept, self._in_data = status, remaining, accept, data
+
+        # Apply the latest value of any held back messages after notes
+        if deferred:
+            for message in deferred.values():
+                self.timestamp = message[3]
+                callback(message[0], message[1], message[2])
+            count += len(deferred)
+            deferred.clear()
+
+        self.timestamp = None
+
+        self.received += count
+        return count
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure the throughput of MIDI input parsing and dispatch")
+    parser.add_argument("-n", "--messages", type=int, default=10000)
+    parser.add_argument("-l", "--limit", type=int, default=32, help="messages dispatched per receive")
+    args = parser.parse_args()
+
+    class Input:
+        def __init__(self, data:bytes):
+            self._data = data
+            self._index = 0
+
+        @property
+        def in_waiting(self) -> int:
+            return len(self._data) - self._index
+
+        def read(self, size:int) -> bytes:
+            data = self._data[self._index:self._index + size]
+            self._index += len(data)
+            return data
+
+    def get_stream(count:int, channels:int = 1) -> bytes:
+        """Notes and controllers with running status spread over a number of channels, interrupted
+        by timing clock and system exclusive.
+        """
+        data = bytearray()
+        status = 0
+        for i in range(count):
+            if i % 100 == 99:
+                data.extend(bytes((SYSTEM_EXCLUSIVE,)) + bytes(range(16)) + bytes((SYSTEM_EXCLUSIVE_END,)))
+                status = 0
+                continue
+            message = (NOTE_ON, i % 128, i % 2 * 100) if i % 4 < 2 else (CONTROL_CHANGE, 1, i % 128)
+            if message[0] | (i % channels) != status:
+                status = message[0] | (i % channels)
+                data.append(status)
+            data.append(message[1])
+            if i % 8 == 7:
+                data.append(TIMING_CLOCK)
+            data.append(message[2])
+        return bytes(data)
+
+    # Dispatch by status nibble as by midi.Router
+    def count(status:int, data1:int, data2:int) -> None:
+        pass
+    handlers = [count] * 16
+    def dispatch(status:int, data1:int, data2:int) -> None:
+        handlers[status >> 4](status, data1, data2)
+
+    for channels, channel in ((1, None), (16, None), (16, 1)):
+        data = get_stream(args.messages, channels)
+        port = Port(Input(data), None)
+        port.channel = channel
+        start = time.perf_counter()
+        received = 0
+        while port.backlog:
+            port.read()
+            received += port.receive(dispatch, limit=args.limit)
+        duration = time.perf_counter() - start
+        print("midiport: channels={:d} filter={:s} messages={:d} filtered={:d} bytes={:d} time={:.1f}ms rate={:.0f}msg/s".format(
+            channels, str(channel) if channel is not None else "all", received, port.filtered, len(data), duration * 1000, args.messages / duration
+        ))
@@ -0,0 +1,196 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Pitch detection of samples with results cached alongside the sample directory
+
+import os
+import json
+import math
+
+try:
+    import ulab.numpy as np
+except ImportError:
+    import numpy as np
+
+RATE = 11025 # Analysis sample rate (hz)
+WINDOW = 1024 # Analysis window length at analysis rate
+MINIMUM = 40.0 # Lowest detected frequency (hz)
+MAXIMUM = 2000.0 # Highest detected frequency (hz)
+THRESHOLD = 0.9 # Ratio of the highest peak which a candidate peak must reach
+
+def get_window(waveform:np.ndarray, sample_rate:int, size:int = WINDOW, rate:int = RATE) -> np.ndarray:
+    """Decimate a waveform to the analysis rate and take a window past the initial transient. Each
+    decimated sample is the average of the samples it replaces to reduce aliasing.
+    """
+    step = max(sample_rate // rate, 1)
+    length = len(waveform) // step
+    start = min(length // 10, max(length - size, 0))
+    count = min(size, length - start)
+    window = np.zeros(count)
+    for i in range(step):
+        window += waveform[start * step + i:(start + count) * step:step] * 1.0
+    return window - np.mean(window)
+
+def autocorrelation(waveform:np.ndarray, sample_rate:int) -> tuple:
+    """Estimate the fundamental frequency with the normalized autocorrelation of a short window.
+    Returns the frequency (hz) and confidence (0.0-1.0).
+    """
+    window = get_window(waveform, sample_rate)
+    rate = sample_rate / max(sample_rate // RATE, 1)
+    size = len(window)
+    energy = np.dot(window, window)
+    if size < 8 or energy <= 0.0:
+        return 0.0, 0.0
+
+    start = max(int(rate / MAXIMUM), 1)
+    values = [np.dot(window[:-i], window[i:]) / energy for i in range(start, min(int(rate / MINIMUM), size // 2))]
+    if not values or (peak := max(values)) <= 0.0:
+        return 0.0, 0.0
+
+    # Take the first peak near the maximum to avoid choosing a multiple of the period
+    for i in range(1, len(values) - 1):
+        if values[i] >= peak * 0.9 and values[i] >= values[i - 1] and values[i] >= values[i + 1]:
+            return rate / (start + i), float(values[i])
+    return rate / (start + values.index(peak)), float(peak)
+
+def _real(value:tuple|np.ndarray) -> np.ndarray:
+    # ulab without complex support returns the real and imaginary parts of a transform as a tuple
+    return value[0] if type(value) is tuple else np.real(value)
+
+def mcleod(waveform:np.ndarray, sample_rate:int, rate:int = RATE) -> tuple:
+    """Estimate the fundamental frequency with the McLeod pitch method. The autocorrelation of the
+    window is calculated from its power spectrum and normalized into the NSDF, from which the first
+    peak within range of the highest is refined with parabolic interpolation. Returns the frequency
+    (hz) and clarity (0.0-1.0).
+    """
+    window = get_window(waveform, sample_rate, rate=rate)
+    rate = sample_rate / max(sample_rate // rate, 1)
+    size = len(window)
+    if size < 8:
+        return 0.0, 0.0
+
+    # Zero pad to a power of two of at least twice the window to avoid circular correlation
+    length = 1
+    while length < size * 2:
+        length *= 2
+    padded = np.zeros(length)
+    padded[:size] = window
+    spectrum = np.fft.fft(padded)
+    if type(spectrum) is tuple:
+        power = spectrum[0] * spectrum[0] + spectrum[1] * spectrum[1]
+    else:
+        power = np.real(spectrum * np.conjugate(spectrum))
+    correlation = _real(np.fft.ifft(power))[:size // 2]
+
+    # Normalize by the energy of both overlapping parts of the window at each lag
+    squares = window * window
+    total = 2 * np.sum(squares)
+    if total <= 0.0:
+        return 0.0, 0.0
+    nsdf = [0.0] * len(correlation)
+    for i in range(len(correlation)):
+        nsdf[i] = 2 * float(correlation[i]) / total if total > 0.0 else 0.0
+        total -= float(squares[i]) + float(squares[size - 1 - i])
+
+    # Find the maximum of each complete positive region following a negative zero crossing
+    minimum, maximum = rate / MAXIMUM, rate / MINIMUM
+    peaks = []
+    end = len(nsdf) - 1
+    i = 1
+    while i < end and nsdf[i] > 0.0:
+        i += 1
+    while i < end:
+        while i < end and nsdf[i] <= 0.0:
+            i += 1
+        peak = i
+        while i < end and nsdf[i] > 0.0:
+            if nsdf[i] > nsdf[peak]:
+                peak = i
+            i += 1
+        if i < end and minimum <= peak <= maximum:
+            peaks.append(peak)
+    if not peaks:
+        return 0.0, 0.0
+
+    # Refine each peak between lags with parabolic interpolation
+    for i, peak in enumerate(peaks):
+        previous, current, following = nsdf[peak - 1], nsdf[peak], nsdf[peak + 1]
+        curve = previous - 2 * current + following
+        offset = (previous - following) / (2 * curve) if curve else 0.0
+        peaks[i] = (peak + offset, current - (previous - following) * offset / 4)
+
+    highest = max([peak[1] for peak in peaks])
+    for lag, value in peaks:
+        if value >= highest * THRESHOLD:
+            return rate / lag, min(value, 1.0)
+    return 0.0, 0.0
+
+ALGORITHM = "mpm"
+
+def detect(waveform:np.ndarray, sample_rate:int) -> tuple:
+    """Estimate the fundamental frequency of a waveform, falling back to plain autocorrelation when
+    the McLeod pitch method finds no peak. Returns the frequency (hz), confidence and algorithm.
+    """
+    frequency, confidence = mcleod(waveform, sample_rate)
+    if frequency > RATE / 16 and sample_rate >= RATE * 2:
+        # Periods of only a few samples lose precision after decimation
+        frequency, confidence = mcleod(waveform, sample_rate, sample_rate)
+    if frequency > 0.0:
+        return frequency, confidence, ALGORITHM
+    frequency, confidence = autocorrelation(waveform, sample_rate)
+    return frequency, confidence, "acf"
+
+def to_note(frequency:float) -> tuple:
+    """Convert a frequency (hz) to the nearest midi note number and the remaining fine tune in
+    semitones.
+    """
+    note = 69 + 12 * math.log(frequency / 440) / math.log(2)
+    root = round(note)
+    return root, note - root
+
+def to_frequency(root:int, tune:float = 0.0) -> float:
+    return 440 * 2 ** ((root + tune - 69) / 12)
+
+class Index:
+    """Detected root note, fine tune, confidence and algorithm of each sample in a directory. Entries
+    are keyed by file name and are only detected again when the size or modification time of a file
+    has changed. The index is written back to the directory, if writable, as `pitch.json`.
+    """
+
+    def __init__(self, directory:str):
+        self._path = directory + "/pitch.json"
+        try:
+            with open(self._path, "r") as file:
+                self._entries = json.load(file)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, path:str, waveform:np.ndarray, sample_rate:int) -> dict:
+        stat = os.stat(path)
+        name = path.split("/")[-1]
+        entry = self._entries.get(name)
+        if entry is not None and entry["size"] == stat[6] and entry["mtime"] == stat[8] and entry["algorithm"] in (ALGORITHM, "acf"):
+            return entry
+
+        frequency, confidence, algorithm = detect(waveform, sample_rate)
+        root, tune = to_note(frequency) if frequency > 0.0 else (60, 0.0)
+        entry = self._entries[name] = {
+            "size": stat[6],
+            "mtime": stat[8],
+            "root": root,
+            "tune": tune,
+            "confidence": confidence,
+            "algorithm": algorithm,
+        }
+        print("pitch: {:s} root={:d} tune={:.2f} confidence={:.2f}".format(name, root, tune, confidence))
+        self.write()
+        return entry
+
+    def write(self) -> bool:
+        try:
+            with open(self._path, "w") as file:
+                json.dump(self._entries, file)
+        except OSError:
+            return False
+        return True
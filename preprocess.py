@@ -0,0 +1,143 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Sample preprocessing to resample, normalize, trim and find loop points of WAV files
+#
+# Usage on host: python3 preprocess.py [-r RATE] [-o OUTPUT] [-j JOBS] FILE...
+
+import math
+
+try:
+    import ulab.numpy as np
+except ImportError:
+    import numpy as np
+
+import wav
+import pitch
+
+PEAK = 0.95 # Normalized peak level relative to full scale
+THRESHOLD = 0.02 # Level relative to peak which ends leading silence
+WINDOW = 256 # Length of windows compared when searching for loop points
+CANDIDATES = 128 # Maximum number of loop start positions compared
+CORRELATION = 0.5 # Minimum correlation of an acceptable loop
+
+def read(path:str) -> tuple:
+    """Read a 16-bit PCM WAV file as a mono float array. Returns the data and sample rate."""
+    with open(path, "rb") as file:
+        fmt, channels, sample_rate, bits, block_align, offset, length = wav.read_header(file)
+        if fmt != wav.FORMAT_PCM or bits != 16:
+            raise ValueError("Unsupported WAV format")
+        data = np.frombuffer(file.read(length - length % block_align), dtype=np.int16)
+    mono = np.zeros(len(data) // channels)
+    for i in range(channels):
+        mono += data[i::channels] * (1.0 / channels)
+    return mono, sample_rate
+
+def resample(data:np.ndarray, sample_rate:int, target:int) -> np.ndarray:
+    """Resample data with linear interpolation."""
+    if sample_rate == target or not len(data):
+        return data
+    length = int(len(data) * target / sample_rate)
+    return np.interp(np.arange(length) * (sample_rate / target), np.arange(len(data)), data)
+
+def normalize(data:np.ndarray, peak:float = PEAK) -> np.ndarray:
+    level = np.max(abs(data)) if len(data) else 0.0
+    if level <= 0.0:
+        return data
+    return data * (peak * 32767 / level)
+
+def trim(data:np.ndarray, threshold:float = THRESHOLD) -> np.ndarray:
+    """Remove leading silence, starting at the zero crossing before the first sample above the
+    threshold.
+    """
+    level = np.max(abs(data)) if len(data) else 0.0
+    if level <= 0.0:
+        return data
+    start = int(np.nonzero(abs(data) > level * threshold)[0][0])
+    while start > 0 and data[start - 1] * data[start] > 0.0:
+        start -= 1
+    return data[start:]
+
+def get_crossings(data:np.ndarray, start:int, end:int) -> list:
+    # Indices of rising zero crossings within range
+    segment = data[start:end]
+    rising = (segment[1:] >= 0.0) * (segment[:-1] < 0.0)
+    return [start + 1 + int(i) for i in np.nonzero(rising)[0]]
+
+def find_loop(data:np.ndarray, window:int = WINDOW, candidates:int = CANDIDATES) -> tuple:
+    """Find loop points on rising zero crossings where the audio leading into the loop end most
+    closely matches the audio leading into the loop start, so that the transition is seamless.
+    Returns the start and end indices and the correlation (0.0-1.0), or `None` if no loop reaches the
+    minimum correlation.
+    """
+    length = len(data)
+    ends = get_crossings(data, length * 3 // 4, length - 1)
+    if not ends or length < window * 4:
+        return None
+    end = ends[-1]
+    target = data[end - window:end]
+    target_energy = np.dot(target, target)
+
+    # Loops should cover at least a quarter of the sample to avoid audible repetition
+    starts = get_crossings(data, max(length // 4, window), end - max(length // 4, window * 2))
+    if not starts or target_energy <= 0.0:
+        return None
+    starts = starts[::max(len(starts) // candidates, 1)]
+
+    loop, score = None, CORRELATION
+    for start in starts:
+        source = data[start - window:start]
+        energy = np.dot(source, source)
+        if energy <= 0.0:
+            continue
+        value = float(np.dot(source, target)) / math.sqrt(energy * target_energy)
+        if value > score:
+            loop, score = start, value
+    if loop is None:
+        return None
+    return loop, end, score
+
+def process(path:str, output:str = None, sample_rate:int = None) -> tuple:
+    """Resample, trim, normalize and find the loop points and root note of a WAV file and write the
+    result to the output path, which defaults to the source file. Returns the length, sample rate,
+    loop and root note of the result.
+    """
+    data, rate = read(path)
+    if sample_rate is not None:
+        data, rate = resample(data, rate, sample_rate), sample_rate
+    data = normalize(trim(data))
+    loop = find_loop(data)
+    frequency, confidence, algorithm = pitch.detect(data, rate)
+    root = pitch.to_note(frequency)[0] if frequency > 0.0 else 60
+    wav.write(output if output is not None else path, data, rate, loop[:2] if loop is not None else None, root)
+    return len(data), rate, loop, root
+
+def _process(args:tuple) -> str:
+    path, output, sample_rate = args
+    try:
+        length, rate, loop, root = process(path, output, sample_rate)
+    except (OSError, ValueError) as e:
+        return "{:s}: failed ({:s})".format(path, str(e))
+    return "{:s}: length={:d} rate={:d} loop={:s} root={:d}".format(
+        path, length, rate, "{:d}-{:d} ({:.2f})".format(*loop) if loop is not None else "none", root
+    )
+
+if __name__ == "__main__":
+    import argparse
+    import multiprocessing
+    import os
+
+    parser = argparse.ArgumentParser(description="Preprocess WAV samples for the sampler")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-r", "--rate", type=int, default=None, help="target sample rate, ie: 44100")
+    parser.add_argument("-o", "--output", default=None, help="output directory, defaults to overwriting source files")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of parallel processes")
+    args = parser.parse_args()
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+    jobs = [(path, os.path.join(args.output, os.path.basename(path)) if args.output is not None else None, args.rate) for path in args.files]
+    with multiprocessing.Pool(args.jobs) as pool:
+        for result in pool.imap(_process, jobs):
+            print(result)
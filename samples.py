@@ -0,0 +1,226 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Cache of decoded samples to avoid reading the same file from storage repeatedly
+
+import time
+
+try:
+    import ulab.numpy as np
+except ImportError:
+    import numpy as np
+
+import wav
+import bank
+import codec
+import settings
+
+ALIGN = 4 # Byte alignment of slots
+SCRATCH = 512 # Size of buffer used to move slots during compaction (bytes)
+
+class Arena:
+    """A single block of memory allocated once and divided into slots which each hold a decoded
+    sample. Slots are placed in the first gap large enough and can be compacted towards the start of
+    the arena to join free space, so repeatedly loading samples of different sizes doesn't fragment
+    the heap. Slots which are being played can be kept in place while compacting.
+    """
+
+    def __init__(self, size:int):
+        self._buffer = bytearray(size - size % ALIGN)
+        self._scratch = bytearray(SCRATCH)
+        self._slots = [] # [offset, size] ordered by offset
+
+    @property
+    def size(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def used(self) -> int:
+        return sum([slot[1] for slot in self._slots])
+
+    @property
+    def free(self) -> int:
+        return self.size - self.used
+
+    def allocate(self, size:int) -> list|None:
+        """Reserve a slot of at least the size in bytes. Returns `None` if no gap is large enough."""
+        size = (size + ALIGN - 1) // ALIGN * ALIGN
+        offset, index = 0, len(self._slots)
+        for i, slot in enumerate(self._slots):
+            if slot[0] - offset >= size:
+                index = i
+                break
+            offset = slot[0] + slot[1]
+        if index == len(self._slots) and self.size - offset < size:
+            return None
+        slot = [offset, size]
+        self._slots.insert(index, slot)
+        return slot
+
+    def release(self, slot:list) -> None:
+        self._slots.remove(slot)
+
+    def compact(self, fixed:tuple = tuple()) -> bool:
+        """Move all slots except those which are fixed towards the start of the arena. Returns whether
+        any slot was moved, in which case previous views of those slots are no longer valid.
+        """
+        buffer, scratch = memoryview(self._buffer), self._scratch
+        offset, moved = 0, False
+        for slot in self._slots:
+            if any([slot is item for item in fixed]):
+                offset = slot[0]
+            elif slot[0] != offset:
+                # Copying forwards is safe as slots only move towards the start
+                for i in range(0, slot[1], len(scratch)):
+                    count = min(len(scratch), slot[1] - i)
+                    scratch[:count] = buffer[slot[0] + i:slot[0] + i + count]
+                    buffer[offset + i:offset + i + count] = scratch[:count]
+                slot[0] = offset
+                moved = True
+            offset += slot[1]
+        return moved
+
+    def get_buffer(self, slot:list, size:int = None) -> memoryview:
+        return memoryview(self._buffer)[slot[0]:slot[0] + (size if size is not None else slot[1])]
+
+    def get_view(self, slot:list, count:int) -> np.ndarray:
+        return np.frombuffer(self._buffer, dtype=np.int16, count=count, offset=slot[0])
+
+class Cache:
+    """Keeps recently used samples decoded within an arena. When a new sample doesn't fit, the least
+    recently used samples which aren't pinned are released and, if the remaining free space is split
+    between gaps, the arena is compacted around the pinned samples. Waveforms are views into the
+    arena and are replaced when their slot is moved, at which point :attr:`on_compact` is called.
+    Pinned samples are never moved, since voices may be reading them.
+    """
+
+    def __init__(self, size:int):
+        self._arena = Arena(size)
+        self._buffer = bytearray(SCRATCH) # Interleaved frames read before keeping the first channel
+        self._entries = {} # path: [slot, length, sample_rate, view]
+        self._order = [] # Paths from least to most recently used
+        self.hits = 0
+        self.misses = 0
+        self.on_compact = None
+
+    @property
+    def budget(self) -> int:
+        return self._arena.size
+
+    @property
+    def bytes(self) -> int:
+        return self._arena.used
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, path:str) -> bool:
+        return path in self._entries
+
+    def _allocate(self, size:int, pinned:tuple) -> list:
+        if size > self._arena.size:
+            raise MemoryError("Sample larger than arena")
+        while (slot := self._arena.allocate(size)) is None:
+            if self._arena.free >= size and self._compact(pinned):
+                continue
+            for path in self._order:
+                if path not in pinned:
+                    self.remove(path)
+                    break
+            else:
+                raise MemoryError("Samples in use fill arena")
+        return slot
+
+    def _compact(self, pinned:tuple) -> bool:
+        if not self._arena.compact(tuple([entry[0] for path, entry in self._entries.items() if path in pinned])):
+            return False
+        for entry in self._entries.values():
+            entry[3] = self._arena.get_view(entry[0], entry[1])
+        if self.on_compact is not None:
+            self.on_compact()
+        return True
+
+    def find(self, path:str) -> np.ndarray|None:
+        """Get the current waveform of a sample if it is cached without affecting its usage."""
+        return entry[3] if (entry := self._entries.get(path)) is not None else None
+
+    def get(self, path:str, pinned:tuple = tuple()) -> tuple:
+        """Get the waveform and sample rate of a WAV file (16-bit PCM, µ-law or IMA ADPCM) or a sample
+        within a bank. Samples within pinned paths are kept if space is needed.
+        """
+        if (entry := self._entries.get(path)) is not None:
+            self._order.remove(path)
+            self._order.append(path)
+            self.hits += 1
+            return entry[3], entry[2]
+        self.misses += 1
+        start = time.monotonic_ns()
+
+        if bank.is_entry(path):
+            view, count, sample_rate, slot = self._read_bank(path, pinned)
+        else:
+            view, count, sample_rate, slot = self._read_wav(path, pinned)
+
+        self._entries[path] = [slot, count, sample_rate, view]
+        self._order.append(path)
+        if settings.performance_telemetry:
+            print("samples: hits={:d} misses={:d} bytes={:d}/{:d} load={:d}ms".format(self.hits, self.misses, self.bytes, self.budget, (time.monotonic_ns() - start) // 1000000))
+        return view, sample_rate
+
+    def _read_bank(self, path:str, pinned:tuple) -> tuple:
+        # Bank samples are mono 16-bit and are read with a single seek
+        source, entry = bank.get(path)
+        slot = self._allocate(entry.length * 2, pinned)
+        try:
+            source.readinto(entry, self._arena.get_buffer(slot, entry.length * 2))
+        except OSError:
+            self._arena.release(slot)
+            raise
+        return self._arena.get_view(slot, entry.length), entry.length, entry.sample_rate, slot
+
+    def _read_wav(self, path:str, pinned:tuple) -> tuple:
+        with open(path, "rb") as file:
+            fmt, channels, sample_rate, bits, block_align, offset, length = wav.read_header(file)
+            if fmt == wav.FORMAT_IMA_ADPCM and bits == 4:
+                # Whole blocks are decoded together, the final partial block is dropped
+                frames = codec.get_block_samples(block_align, channels)
+                count = length // block_align * frames
+                buffer = bytearray(block_align * codec.BLOCKS)
+            elif (fmt == wav.FORMAT_PCM and bits == 16) or (fmt == wav.FORMAT_MULAW and bits == 8):
+                frames = len(self._buffer) // block_align
+                count = length // block_align
+                buffer = self._buffer
+            else:
+                raise ValueError("Unsupported WAV format")
+            slot = self._allocate(count * 2, pinned)
+            view = self._arena.get_view(slot, count)
+            try:
+                if fmt == wav.FORMAT_PCM and channels == 1:
+                    file.readinto(self._arena.get_buffer(slot, count * 2))
+                elif fmt == wav.FORMAT_IMA_ADPCM:
+                    for i in range(0, count, frames * codec.BLOCKS):
+                        size = file.readinto(memoryview(buffer)[:min(len(buffer), (count - i) // frames * block_align)])
+                        view[i:i + size // block_align * frames] = codec.decode_adpcm(memoryview(buffer)[:size], block_align, channels)
+                else:
+                    # Only the first channel is kept so the slot never holds the interleaved frames
+                    for i in range(0, count, frames):
+                        size = min(frames, count - i)
+                        file.readinto(memoryview(buffer)[:size * block_align])
+                        if fmt == wav.FORMAT_MULAW:
+                            view[i:i + size] = codec.decode_mulaw(memoryview(buffer)[:size * block_align], channels)
+                        else:
+                            view[i:i + size] = np.frombuffer(buffer, dtype=np.int16, count=size * channels)[::channels]
+            except OSError:
+                self._arena.release(slot)
+                raise
+        return view, count, sample_rate, slot
+
+    def remove(self, path:str) -> None:
+        if (entry := self._entries.pop(path, None)) is not None:
+            self._order.remove(path)
+            self._arena.release(entry[0])
+
+    def clear(self) -> None:
+        for path in tuple(self._order):
+            self.remove(path)
@@ -12,9 +12,26 @@ PATH = "/settings.json"
 midi_channel = None
 midi_thru = False
 midi_touch_out = False
+midi_notes = True
+midi_control = True
+midi_bend = True
+midi_pressure = True
+midi_program = True
+midi_system = True
+midi_clock = False
 
 keyboard_touch = True
 
+performance_governor = True
+performance_telemetry = False
+
+revision = 0 # Incremented whenever a setting is changed
+
+def set_value(value:any, name:str) -> None:
+    global revision
+    globals()[name] = value
+    revision += 1
+
 def _format_name(name:str) -> str:
     return name.lower().replace(' ', '_')
 
@@ -57,24 +74,71 @@ def group() -> synthmenu.Group:
                     step=1,
                     minimum=0,
                     maximum=16,
-                    on_update=lambda value, item: menu.set_global_attribute(None if value == 0 else value, 'midi_channel')
+                    on_update=lambda value, item: set_value(None if value == 0 else value, 'midi_channel')
                 ),
                 synthmenu.Bool(
                     title="Thru",
                     default=midi_thru,
-                    on_update=lambda value, item: menu.set_global_attribute(value, 'midi_thru'),
+                    on_update=lambda value, item: set_value(value, 'midi_thru'),
                 ),
                 synthmenu.Bool(
                     title="Touch Out",
                     default=midi_touch_out,
-                    on_update=lambda value, item: menu.set_global_attribute(value, 'midi_touch_out'),
+                    on_update=lambda value, item: set_value(value, 'midi_touch_out'),
+                ),
+                synthmenu.Bool(
+                    title="Notes",
+                    default=midi_notes,
+                    on_update=lambda value, item: set_value(value, 'midi_notes'),
+                ),
+                synthmenu.Bool(
+                    title="Control",
+                    default=midi_control,
+                    on_update=lambda value, item: set_value(value, 'midi_control'),
+                ),
+                synthmenu.Bool(
+                    title="Bend",
+                    default=midi_bend,
+                    on_update=lambda value, item: set_value(value, 'midi_bend'),
+                ),
+                synthmenu.Bool(
+                    title="Pressure",
+                    default=midi_pressure,
+                    on_update=lambda value, item: set_value(value, 'midi_pressure'),
+                ),
+                synthmenu.Bool(
+                    title="Program",
+                    default=midi_program,
+                    on_update=lambda value, item: set_value(value, 'midi_program'),
+                ),
+                synthmenu.Bool(
+                    title="System",
+                    default=midi_system,
+                    on_update=lambda value, item: set_value(value, 'midi_system'),
+                ),
+                synthmenu.Bool(
+                    title="Clock",
+                    default=midi_clock,
+                    on_update=lambda value, item: set_value(value, 'midi_clock'),
                 ),
             )),
             synthmenu.Group("Keyboard", tuple([
                 synthmenu.Bool(
                     title="Touch",
                     default=keyboard_touch,
-                    on_update=lambda value, item: menu.set_global_attribute(value, 'keyboard_touch'),
+                    on_update=lambda value, item: set_value(value, 'keyboard_touch'),
+                ),
+            ])),
+            synthmenu.Group("Performance", tuple([
+                synthmenu.Bool(
+                    title="Governor",
+                    default=performance_governor,
+                    on_update=lambda value, item: set_value(value, 'performance_governor'),
+                ),
+                synthmenu.Bool(
+                    title="Telemetry",
+                    default=performance_telemetry,
+                    on_update=lambda value, item: set_value(value, 'performance_telemetry'),
                 ),
             ])),
             synthmenu.Action("Save", save),
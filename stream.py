@@ -0,0 +1,226 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Streaming of samples larger than memory from storage through per-voice ring buffers
+
+import asyncio
+import time
+import synthio
+
+try:
+    import ulab.numpy as np
+except ImportError:
+    import numpy as np
+
+import hardware
+import wav
+
+RING = 3 # Length of each voice ring buffer in mixer buffers, which is also the length of the resident attack
+CHUNK = 256 # Samples read from storage per scheduling step
+
+def get_latency() -> int:
+    """The number of frames which the mixer renders ahead of the output."""
+    return hardware.BUFFER_SIZE // (hardware.CHANNELS * hardware.BITS // 8)
+
+class Sample:
+    """A 16-bit PCM WAV file of which only the header and attack are held in memory."""
+
+    def __init__(self, path:str, size:int = None):
+        if size is None:
+            size = RING * get_latency()
+        self.path = path
+        with open(path, "rb") as file:
+            fmt, self.channels, self.sample_rate, bits, self.block_align, self.offset, length = wav.read_header(file)
+            if fmt != wav.FORMAT_PCM or bits != 16:
+                raise ValueError("Unsupported WAV format")
+            self.length = length // self.block_align
+            count = min(size, self.length)
+            data = np.frombuffer(file.read(count * self.block_align), dtype=np.int16)
+        self.attack = np.zeros(size, dtype=np.int16)
+        self.attack[:count] = data[::self.channels]
+
+class Stream:
+    def __init__(self, voice:object, size:int):
+        self.voice = voice
+        self.ring = np.zeros(size, dtype=np.int16)
+        self.file = None
+        self.active = False
+        self.ended = False
+        self.position = 0.0 # Estimated play position of the output (samples)
+        self.filled = 0 # Samples written to the ring since press
+        self.index = 0 # Read position within file (samples)
+
+class Streamer:
+    """Plays samples which are too large to fit in memory on a group of sample voices. The waveform
+    of each voice is a ring buffer which synthio loops over continuously. On press, the ring is
+    loaded with the resident attack of the sample and the remainder is read from storage into the
+    ring behind the play position, which is estimated from the frequency and bend of the voice's
+    note. Since the mixer renders a buffer ahead of the output, synthio reads the ring up to a buffer
+    ahead of the estimate, so the ring is sized to several mixer buffers and data must always be
+    written beyond that point. A modulated bend, such as vibrato or glide, is sampled at its value on
+    each update, so the estimate drifts slightly and a small guard is kept behind it.
+
+    Reads are shared between voices by always serving the voice with the least audio buffered ahead
+    of its play position until the time budget of each update is spent. If storage can't keep up and
+    a voice plays past the data written to its ring, the ring is silenced and the voice is released
+    rather than letting it repeat stale audio.
+    """
+
+    def __init__(self, synthesizer:synthio.Synthesizer, voices:tuple, size:int = None, chunk:int = CHUNK, budget:float = None):
+        self._synthesizer = synthesizer
+        self._voices = voices
+        self._latency = get_latency() / hardware.SAMPLE_RATE # Render ahead time of the mixer (s)
+        self._size = size if size is not None else RING * get_latency()
+        self._minimum = get_latency() + 2 * chunk # Render ahead of the mixer plus the guard and a read
+        self._guard = chunk # Allowance for error in the estimated play position
+        self._chunk = chunk
+        self._budget = int((budget if budget is not None else hardware.TASK_SLEEP / 2) * 1000000000)
+        self._buffer = None
+        self._streams = None
+        self._sample = None
+        self.looping = True
+        self.underruns = 0
+        self.on_underrun = None
+
+    @property
+    def sample(self) -> Sample:
+        return self._sample
+
+    @property
+    def size(self) -> int:
+        """The length of each voice ring buffer and of the resident attack (samples)."""
+        return self._size
+
+    @property
+    def available(self) -> bool:
+        """Whether rings have been reserved for streaming."""
+        return self._streams is not None
+
+    def reserve(self, memory:int) -> bool:
+        """Allocate the ring of each voice, along with the attack of a sample, within the given number
+        of bytes. The rings are shortened to fit if necessary. Returns `False` if there isn't enough
+        memory to stream.
+        """
+        self.unload()
+        self._streams = None
+        # Each ring and the attack are 16-bit
+        size = min(self._size, memory // ((len(self._voices) + 1) * 2))
+        size -= size % self._chunk
+        if size < self._minimum:
+            return False
+        try:
+            self._streams = tuple([Stream(voice, size) for voice in self._voices])
+        except MemoryError:
+            return False
+        self._size = size
+        return True
+
+    def load(self, path:str) -> Sample:
+        self.unload()
+        if self._streams is None:
+            raise MemoryError("No memory reserved for streaming")
+        self._sample = Sample(path, self._size)
+        self._buffer = bytearray(self._chunk * self._sample.block_align)
+        for stream in self._streams:
+            stream.ring[:] = self._sample.attack
+            stream.file = open(path, "rb")
+            stream.voice.waveform = stream.ring
+            stream.voice.sample_rate = self._sample.sample_rate
+            stream.voice.looping = True
+            stream.voice.waveform_loop = (0.0, 1.0)
+        return self._sample
+
+    def unload(self) -> None:
+        if self._streams is not None:
+            for stream in self._streams:
+                stream.active = False
+                if stream.file is not None:
+                    stream.file.close()
+                    stream.file = None
+        self._sample = None
+        self._buffer = None
+
+    def press(self, index:int) -> None:
+        """Reset the ring of a voice to the start of the sample. Should be called before the voice is
+        pressed.
+        """
+        if self._sample is None:
+            return
+        stream = self._streams[index]
+        stream.ring[:] = self._sample.attack
+        stream.position = 0.0
+        stream.filled = stream.index = min(self._size, self._sample.length)
+        stream.ended = False
+        stream.file.seek(self._sample.offset + stream.index * self._sample.block_align)
+        stream.active = True
+
+    def _advance(self, stream:Stream, delta:float) -> None:
+        note = stream.voice.notes[0]
+        if self._synthesizer.note_info(note)[0] is None:
+            stream.active = False # Note has finished releasing
+            return
+        bend = note.bend
+        if type(bend) is not float:
+            bend = getattr(bend, 'value', 0.0)
+        rate = note.frequency * self._size * 2 ** bend
+        stream.position += rate * delta
+        if stream.position + rate * self._latency >= stream.filled:
+            stream.active = False
+            if stream.ended:
+                return
+            stream.ring[:] = 0
+            self.underruns += 1
+            print("stream: underrun voice={:d} underruns={:d}".format(self._streams.index(stream), self.underruns))
+            if self.on_underrun is not None:
+                self.on_underrun(self._streams.index(stream))
+
+    def _fill(self, stream:Stream) -> bool:
+        count = min(int(stream.position) + self._size - self._guard - stream.filled, self._chunk)
+        if count <= 0:
+            return False
+        sample = self._sample
+        if stream.index >= sample.length and self.looping:
+            stream.file.seek(sample.offset)
+            stream.index = 0
+        start = stream.filled % self._size
+        if stream.index >= sample.length:
+            stream.ended = True
+            data = None
+        else:
+            count = min(count, sample.length - stream.index)
+            stream.file.readinto(memoryview(self._buffer)[:count * sample.block_align])
+            data = np.frombuffer(self._buffer, dtype=np.int16)[:count * sample.channels:sample.channels]
+            stream.index += count
+
+        first = min(count, self._size - start)
+        if data is None:
+            stream.ring[start:start + first] = 0
+            stream.ring[:count - first] = 0
+        else:
+            stream.ring[start:start + first] = data[:first]
+            stream.ring[:count - first] = data[first:]
+        stream.filled += count
+        return True
+
+    async def update(self) -> None:
+        last = time.monotonic_ns()
+        while True:
+            await asyncio.sleep(hardware.TASK_SLEEP)
+            now = time.monotonic_ns()
+            delta, last = (now - last) / 1000000000, now
+            if self._sample is None:
+                continue
+
+            for stream in self._streams:
+                if stream.active:
+                    self._advance(stream, delta)
+
+            while time.monotonic_ns() - now < self._budget:
+                # Serve the voice closest to running out first
+                urgent, margin = None, self._size
+                for stream in self._streams:
+                    if stream.active and stream.filled - stream.position < margin:
+                        urgent, margin = stream, stream.filled - stream.position
+                if urgent is None or not self._fill(urgent):
+                    break
@@ -0,0 +1,171 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Performance telemetry of the event loop, audio buffer and memory
+
+import asyncio
+import time
+import gc
+import synthmenu
+
+import hardware
+import settings
+
+INTERVAL = 1.0
+LATE = 0.002
+WINDOW = 8 # Iterations of which only the shortest wakeup lag is kept
+
+class Stat:
+    """Minimum, average and maximum of values recorded over the current interval."""
+
+    def __init__(self):
+        self.minimum = 0.0
+        self.average = 0.0
+        self.maximum = 0.0
+        self.reset()
+
+    def reset(self) -> None:
+        self._minimum = None
+        self._maximum = None
+        self._total = 0.0
+        self._count = 0
+
+    def append(self, value:float) -> None:
+        if self._minimum is None or value < self._minimum:
+            self._minimum = value
+        if self._maximum is None or value > self._maximum:
+            self._maximum = value
+        self._total += value
+        self._count += 1
+
+    def roll(self) -> None:
+        if self._count:
+            self.minimum = self._minimum
+            self.average = self._total / self._count
+            self.maximum = self._maximum
+        self.reset()
+
+    def __str__(self) -> str:
+        return "{:.1f}/{:.1f}/{:.1f}".format(self.minimum, self.average, self.maximum)
+
+class Histogram:
+    """Count of values within each range of bounds, ie: latency in milliseconds."""
+
+    def __init__(self, bounds:tuple = (1, 2, 4, 8, 16, 32, 64)):
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def append(self, value:float) -> None:
+        for i, bound in enumerate(self._bounds):
+            if value < bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def reset(self) -> None:
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+
+    def __str__(self) -> str:
+        return " ".join(["<{}:{:d}".format(bound, count) for bound, count in zip(self._bounds, self.counts)] + [">={}:{:d}".format(self._bounds[-1], self.counts[-1])])
+
+def buffer_time() -> float:
+    """Duration in milliseconds of a single audio buffer."""
+    return hardware.BUFFER_SIZE / (hardware.CHANNELS * hardware.BITS // 8) / hardware.SAMPLE_RATE * 1000
+
+loop = Stat() # Event loop iteration time (ms)
+margin = Stat() # Estimated audio buffer margin (ms)
+gc_pause = Stat() # Duration of iterations in which garbage was collected (ms)
+mem_free = Stat() # Free heap (kb)
+jitter = Stat() # Phase error of timer steps against external MIDI clock (ms)
+patch = Stat() # Time to apply a patch change (ms)
+lag = 0.0 # Average wakeup lag of the event loop without blocking UI and storage work (s)
+late = 0 # Late task wakeups within last interval
+underruns = 0 # Iterations which exceeded the audio buffer within last interval
+_late = 0
+_underruns = 0
+
+_stats = (("Loop", loop), ("Margin", margin), ("GC", gc_pause), ("Mem", mem_free), ("Jit", jitter), ("Patch", patch))
+
+def roll() -> None:
+    global late, underruns, _late, _underruns
+    for title, stat in _stats:
+        stat.roll()
+    late, underruns = _late, _underruns
+    _late, _underruns = 0, 0
+    if not settings.performance_telemetry:
+        return
+    print("telemetry: loop={:s} late={:d} margin={:s} underruns={:d} gc={:s} mem={:s} jitter={:s} lag={:.2f}ms".format(
+        str(loop), late, str(margin), underruns, str(gc_pause), str(mem_free), str(jitter), lag * 1000
+    ))
+    import midi
+    for i, port in enumerate(midi.get_ports()):
+        print("telemetry: midi={:d} backlog={:d}/{:d} received={:d} coalesced={:d} filtered={:d} queue={:d}/{:d} dropped={:d}".format(
+            i, port.backlog, port.max_backlog, port.received, port.coalesced, port.filtered, port.depth, port.max_depth, port.dropped
+        ))
+        print("telemetry: midi={:d} latency(ms) {:s}".format(i, str(port.latency)))
+
+def record_patch(index:int, count:int, duration:float) -> None:
+    """Record the number of update callbacks fired and the time (ms) taken by a patch change."""
+    patch.append(duration)
+    if settings.performance_telemetry:
+        print("telemetry: patch={:d} updates={:d} time={:.1f}ms".format(index, count, duration))
+
+async def update() -> None:
+    """Measure the event loop while telemetry or the polyphony governor is enabled. Audio rendering
+    delays every wakeup while menu, display and storage work blocks the loop for single iterations,
+    so :data:`lag` only follows the shortest wakeup of each window.
+    """
+    global lag, _late, _underruns
+    last = time.monotonic_ns()
+    elapsed = 0
+    count = 0
+    shortest = 0.0
+    free = gc.mem_free()
+    while True:
+        if not settings.performance_telemetry and not settings.performance_governor:
+            await asyncio.sleep(INTERVAL)
+            last = time.monotonic_ns()
+            continue
+
+        await asyncio.sleep(hardware.TASK_SLEEP)
+        now = time.monotonic_ns()
+        delta = (now - last) / 1000000
+        last = now
+
+        shortest = delta if not count else min(shortest, delta)
+        count += 1
+        if count >= WINDOW:
+            count = 0
+            lag += (max(shortest / 1000 - hardware.TASK_SLEEP, 0.0) - lag) * 0.25
+
+        if not settings.performance_telemetry:
+            continue
+        elapsed += delta
+
+        loop.append(delta)
+        if delta - hardware.TASK_SLEEP * 1000 > LATE * 1000:
+            _late += 1
+        margin.append(buffer_time() - delta)
+        if delta > buffer_time():
+            _underruns += 1
+
+        # An increase in free memory means a collection occurred during this iteration
+        previous, free = free, gc.mem_free()
+        mem_free.append(free / 1024)
+        if free > previous:
+            gc_pause.append(delta)
+
+        if elapsed >= INTERVAL * 1000:
+            elapsed = 0
+            roll()
+
+def group() -> synthmenu.Group:
+    return synthmenu.Group("Stats", tuple([
+        synthmenu.Action(lambda item, title=title, stat=stat: "{:s} {:s}".format(title, str(stat)), lambda: None)
+        for title, stat in _stats
+    ] + [
+        synthmenu.Action(lambda item: "Late {:d}".format(late), lambda: None),
+        synthmenu.Action(lambda item: "Xrun {:d}".format(underruns), lambda: None),
+    ]))
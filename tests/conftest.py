@@ -0,0 +1,13 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Host tests of modules which don't depend on CircuitPython hardware, run from this directory with:
+# python3 -m pytest
+# The firmware's code.py would shadow the standard library module of the same name if the repository
+# root came first on the path, so it is appended instead.
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,30 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+import numpy as np
+import pytest
+
+import bank
+
+@pytest.mark.parametrize("path", ("/samples/piano-C#4.wav", "/samples/C#.map", "/samples/keys#2.wav"))
+def test_sharp_in_filename_is_not_entry(path):
+    assert not bank.is_entry(path)
+
+def test_entry_with_sharp():
+    path = "/samples/keys#2.bank#piano-C#4"
+    assert bank.is_entry(path)
+    assert bank.split(path) == ("/samples/keys#2.bank", "piano-C#4")
+
+def test_get_entry_with_sharp(tmp_path):
+    data = np.arange(100, dtype=np.int16)
+    path = str(tmp_path / "keys.bank")
+    bank.pack(path, [("piano-C#4", data, 22050, 61, 0.0, None), ("piano-D4", data[::-1].copy(), 22050, 62, 0.0, (10, 90))])
+    source, entry = bank.get(path + bank.SEPARATOR + "piano-C#4")
+    assert entry.root == 61
+    buffer = bytearray(entry.length * 2)
+    source.readinto(entry, buffer)
+    assert np.array_equal(np.frombuffer(buffer, dtype=np.int16), data)
+    with pytest.raises(ValueError):
+        bank.get(path + bank.SEPARATOR + "piano-E4")
+    source.close()
@@ -0,0 +1,37 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+import json
+import pytest
+
+from keymap import Keymap
+
+def get_keymap(tmp_path, zones:list) -> Keymap:
+    path = tmp_path / "test.map"
+    path.write_text(json.dumps(zones))
+    return Keymap(str(path), str(tmp_path))
+
+@pytest.mark.parametrize("velocity,file", ((0, "soft.wav"), (95, "soft.wav"), (96, "hard.wav"), (127, "hard.wav")))
+def test_velocity_boundary(tmp_path, velocity, file):
+    keymap = get_keymap(tmp_path, [
+        {"file": "soft.wav", "velocity": [0, 95]},
+        {"file": "hard.wav", "velocity": [96, 127]},
+    ])
+    assert keymap.get(60, velocity / 127).path.endswith(file)
+
+def test_velocity_gap(tmp_path):
+    keymap = get_keymap(tmp_path, [{"file": "mid.wav", "velocity": [40, 80]}])
+    assert keymap.get(60, 39 / 127) is None
+    assert keymap.get(60, 40 / 127).path.endswith("mid.wav")
+    assert keymap.get(60, 80 / 127).path.endswith("mid.wav")
+    assert keymap.get(60, 81 / 127) is None
+
+def test_overlap_priority(tmp_path):
+    keymap = get_keymap(tmp_path, [
+        {"file": "first.wav", "low": 60, "high": 72, "velocity": [50, 100]},
+        {"file": "second.wav"},
+    ])
+    assert keymap.get(65, 75 / 127).path.endswith("first.wav")
+    assert keymap.get(65, 101 / 127).path.endswith("second.wav")
+    assert keymap.get(59, 75 / 127).path.endswith("second.wav")
@@ -0,0 +1,218 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+import pytest
+
+import midiport
+
+class Output:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data:bytes) -> None:
+        self.data.extend(data)
+
+class NoteOn:
+    """Stand-in for adafruit_midi.note_on.NoteOn, which can't be serialized without a channel."""
+
+    def __init__(self, note:int, velocity:int, channel:int = None):
+        self.note = note
+        self.velocity = velocity
+        self.channel = channel
+
+    def __bytes__(self) -> bytes:
+        return bytes((midiport.NOTE_ON | self.channel, self.note, self.velocity))
+
+def get_port() -> tuple:
+    output = Output()
+    return midiport.Port(None, output), output
+
+def test_send_without_channel_uses_out_channel():
+    port, output = get_port()
+    msg = NoteOn(60, 100)
+    port.send(msg)
+    port.out_channel = 9
+    port.send(NoteOn(62, 100))
+    port.flush()
+    assert bytes(output.data) == bytes((0x90, 60, 100, 0x99, 62, 100))
+    assert msg.channel is None
+
+def test_send_with_channel():
+    port, output = get_port()
+    port.out_channel = 9
+    port.send(NoteOn(60, 100, 3))
+    port.flush()
+    assert bytes(output.data) == bytes((0x93, 60, 100))
+
+def test_send_adafruit_midi_without_channel():
+    note_on = pytest.importorskip("adafruit_midi.note_on")
+    port, output = get_port()
+    port.send(note_on.NoteOn(60, 100))
+    port.flush()
+    assert bytes(output.data) == bytes((0x90, 60, 100))
+
+def test_forward_passes_bytes():
+    port, output = get_port()
+    port.forward(bytes((0x90, 60, 100, 0xf8)))
+    assert bytes(output.data) == bytes((0x90, 60, 100, 0xf8))
+    assert not port.busy
+
+def test_forward_holds_app_output_until_message_complete():
+    port, output = get_port()
+    port.forward(bytes((0x90, 0x41)))
+    port.send(NoteOn(62, 100, 1))
+    port.flush()
+    assert bytes(output.data) == bytes((0x90, 0x41))
+    port.forward(bytes((0xf8,))) # Realtime doesn't complete the message
+    port.flush()
+    assert port.busy
+    port.forward(bytes((100,)))
+    port.flush()
+    assert bytes(output.data) == bytes((0x90, 0x41, 0xf8, 100, 0x91, 62, 100))
+
+def test_forward_holds_app_output_during_sysex():
+    port, output = get_port()
+    port.forward(bytes((0xf0, 0x01)))
+    port.send(NoteOn(62, 100))
+    port.flush()
+    assert port.busy
+    port.forward(bytes((0x02, 0xf7)))
+    port.flush()
+    assert bytes(output.data) == bytes((0xf0, 0x01, 0x02, 0xf7, 0x90, 62, 100))
+
+def test_forward_restores_running_status():
+    port, output = get_port()
+    port.forward(bytes((0x90, 60, 100)))
+    port.send(NoteOn(64, 100, 1))
+    port.flush()
+    port.forward(bytes((62, 100)))
+    assert bytes(output.data) == bytes((0x90, 60, 100, 0x91, 64, 100, 0x90, 62, 100))
+
+def test_forward_keeps_running_status_of_own_output():
+    port, output = get_port()
+    port.forward(bytes((0x90, 60, 100)))
+    port.forward(bytes((62, 100)))
+    assert bytes(output.data) == bytes((0x90, 60, 100, 62, 100))
+
+class Input:
+    def __init__(self, data:bytes):
+        self._data = bytes(data)
+        self._index = 0
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._data) - self._index
+
+    def read(self, size:int) -> bytes:
+        data = self._data[self._index:self._index + size]
+        self._index += len(data)
+        return data
+
+def receive(data:bytes, channel:int = None, mask:int = midiport.Filter.ALL, limit:int = 32, overload:bool = False) -> tuple:
+    port = midiport.Port(Input(data), None)
+    port.channel = channel
+    port.mask = mask
+    messages = []
+    port.read()
+    port.receive(lambda status, data1, data2: messages.append((status, data1, data2)), limit, overload)
+    return messages, port
+
+def test_receive_running_status():
+    messages, port = receive((0x90, 60, 100, 62, 100, 0xc0, 5, 6))
+    assert messages == [(0x90, 60, 100), (0x90, 62, 100), (0xc0, 5, 0), (0xc0, 6, 0)]
+
+def test_receive_realtime_within_message():
+    messages, port = receive((0x90, 60, 0xf8, 100, 0xfa, 62, 100))
+    assert messages == [(0xf8, 0, 0), (0x90, 60, 100), (0xfa, 0, 0), (0x90, 62, 100)]
+
+def test_receive_sysex_cancels_running_status():
+    messages, port = receive((0x90, 60, 100, 0xf0, 0x01, 0x02, 0xf7, 62, 100, 0x80, 60, 0))
+    assert messages == [(0x90, 60, 100), (0x80, 60, 0)]
+
+def test_receive_channel_filter():
+    messages, port = receive((0x90, 60, 100, 0x91, 62, 100, 64, 100, 0x92, 65, 100), channel=2)
+    assert messages == [(0x91, 62, 100), (0x91, 64, 100)]
+    assert port.filtered == 2
+
+def test_receive_type_filter():
+    messages, port = receive((0xb0, 1, 64, 2, 64, 0x90, 60, 100, 0xf8), mask=midiport.Filter.ALL & ~(midiport.Filter.CONTROL_CHANGE | midiport.Filter.SYSTEM))
+    assert messages == [(0x90, 60, 100)]
+    assert port.filtered == 3
+
+def test_receive_limit():
+    port = midiport.Port(Input((0x90, 60, 100, 62, 100, 64, 100)), None)
+    messages = []
+    port.read()
+    assert port.receive(lambda *message: messages.append(message), 2) == 2
+    assert port.receive(lambda *message: messages.append(message), 2) == 1
+    assert messages == [(0x90, 60, 100), (0x90, 62, 100), (0x90, 64, 100)]
+
+def test_receive_overload_coalesces_controllers():
+    messages, port = receive((0xb0, 1, 10, 1, 20, 0xe0, 0, 64, 0x90, 60, 100, 0xb0, 64, 127, 1, 30, 0xe0, 0, 65), overload=True)
+    # Notes and sustain are handled first, then the latest value of each controller
+    assert messages == [(0x90, 60, 100), (0xb0, 64, 127), (0xb0, 1, 30), (0xe0, 0, 65)]
+    assert port.coalesced == 3
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def monotonic_ns(self) -> int:
+        return self.now
+
+def test_flush_allowance_covers_flush_interval(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(midiport, "time", clock)
+    output = Output()
+    port = midiport.Port(None, output, baudrate=31250)
+    sent = 0
+    for i in range(10):
+        for j in range(40):
+            port.send(NoteOn(j, 100, 0))
+        clock.now += 100000000
+        port.flush()
+    # 400 notes/s at 2 bytes each with running status fits within 3125 bytes/s
+    assert port.dropped == 0
+    assert port.depth == 0
+    assert len(output.data) == 1 + 400 * 2
+
+def test_flush_limits_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(midiport, "time", clock)
+    output = Output()
+    port = midiport.Port(None, output, baudrate=31250)
+    for j in range(60):
+        port.send(NoteOn(j, 100, 0))
+    clock.now += 10000000
+    port.flush()
+    assert len(output.data) <= 32
+
+def test_sysex_waits_for_forwarded_message():
+    port, output = get_port()
+    port.forward(bytes((0x90, 0x41)))
+    port.send(bytes((0xf0, 0x01, 0xf7)))
+    port.flush()
+    assert bytes(output.data) == bytes((0x90, 0x41))
+    port.forward(bytes((100,)))
+    port.flush()
+    assert bytes(output.data) == bytes((0x90, 0x41, 100, 0xf0, 0x01, 0xf7))
+
+def test_sysex_keeps_order():
+    port, output = get_port()
+    port.send(NoteOn(60, 100))
+    port.send(bytes((0xf0, 0x01, 0xf7)))
+    port.send(NoteOn(62, 100))
+    port.send(bytes((0xf8,)))
+    assert bytes(output.data) == bytes((0xf8,)) # Only realtime is written immediately
+    port.flush()
+    assert bytes(output.data) == bytes((0xf8, 0x90, 60, 100, 0xf0, 0x01, 0xf7, 0x90, 62, 100))
+
+def test_controller_not_merged_ahead_of_sysex():
+    port, output = get_port()
+    port.send(bytes((0xb0, 1, 10)))
+    port.send(bytes((0xf0, 0x01, 0xf7)))
+    port.send(bytes((0xb0, 1, 20)))
+    port.send(bytes((0xb0, 1, 30)))
+    port.flush()
+    assert bytes(output.data) == bytes((0xb0, 1, 10, 0xf0, 0x01, 0xf7, 0xb0, 1, 30))
@@ -0,0 +1,92 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+import math
+import os
+import time
+import numpy as np
+import pytest
+
+import pitch
+import preprocess
+
+TOLERANCE = 10.0 # Cents
+NOTES = (36, 45, 57, 60, 69, 76, 84, 93)
+
+def get_tone(note:int, sample_rate:int, harmonics:int = 1, length:float = 0.5) -> np.ndarray:
+    # Harmonics fall off as those of a saw wave
+    t = np.arange(int(sample_rate * length)) / sample_rate
+    frequency = pitch.to_frequency(note)
+    waveform = sum([np.sin(2 * math.pi * frequency * i * t) / i for i in range(1, harmonics + 1) if frequency * i < sample_rate / 2])
+    return np.array(waveform * 16000, dtype=np.int16)
+
+def get_cents(frequency:float, note:int) -> float:
+    return 1200 * math.log2(frequency / pitch.to_frequency(note))
+
+@pytest.mark.parametrize("sample_rate", (22050, 44100))
+@pytest.mark.parametrize("note", NOTES)
+def test_mcleod_sine(note, sample_rate):
+    frequency, clarity = pitch.mcleod(get_tone(note, sample_rate), sample_rate)
+    assert abs(get_cents(frequency, note)) < TOLERANCE
+    assert clarity > 0.9
+
+@pytest.mark.parametrize("sample_rate", (22050, 44100))
+@pytest.mark.parametrize("harmonics", (1, 8))
+@pytest.mark.parametrize("note", NOTES)
+def test_detect(note, harmonics, sample_rate):
+    frequency, confidence, algorithm = pitch.detect(get_tone(note, sample_rate, harmonics), sample_rate)
+    assert abs(get_cents(frequency, note)) < TOLERANCE
+    assert pitch.to_note(frequency)[0] == note
+
+@pytest.mark.parametrize("tune", (-0.4, -0.1, 0.25))
+def test_detect_fine_tune(tune):
+    sample_rate = 44100
+    t = np.arange(sample_rate // 2) / sample_rate
+    waveform = np.array(np.sin(2 * math.pi * pitch.to_frequency(60, tune) * t) * 16000, dtype=np.int16)
+    root, detected = pitch.to_note(pitch.detect(waveform, sample_rate)[0])
+    assert root == 60
+    assert abs(detected - tune) * 100 < TOLERANCE
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "samples")
+
+# Root of each pitched sample from the harmonic series of its spectrum. The voice and chime samples have no clear root.
+ROOTS = {
+    "acoustic-guitar.wav": 48,
+    "banjo.wav": 60,
+    "bass-guitar.wav": 36,
+    "cello-bow.wav": 60,
+    "cello-pluck.wav": 48,
+    "electric-guitar.wav": 60,
+    "mandolin.wav": 69,
+    "melodica.wav": 72,
+    "otomatone.wav": 72,
+    "piano.wav": 60,
+    "ukulele.wav": 72,
+}
+
+# Samples whose root isn't found yet, with the reason
+FAILING = {
+    "acoustic-guitar.wav": "strummed chord is detected as E3",
+}
+
+DURATION = 0.05 # Maximum time to detect the pitch of a sample on the host (s)
+
+def read_sample(name:str) -> tuple:
+    data, sample_rate = preprocess.read(os.path.join(SAMPLES, name))
+    return np.array(data, dtype=np.int16), sample_rate
+
+@pytest.mark.parametrize("name", [
+    pytest.param(name, marks=pytest.mark.xfail(reason=FAILING[name], strict=True)) if name in FAILING else name
+    for name in ROOTS
+])
+def test_detect_sample(name):
+    frequency, confidence, algorithm = pitch.detect(*read_sample(name))
+    assert pitch.to_note(frequency)[0] == ROOTS[name]
+
+@pytest.mark.parametrize("name", sorted([name for name in os.listdir(SAMPLES) if name.endswith(".wav")]))
+def test_detect_sample_duration(name):
+    data, sample_rate = read_sample(name)
+    start = time.perf_counter()
+    pitch.detect(data, sample_rate)
+    assert time.perf_counter() - start < DURATION
@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+import numpy as np
+import pytest
+
+import wavetable
+
+SAMPLE_RATE = 48000
+FLOOR = 1e-4 # Level relative to the fundamental below which a harmonic is considered absent
+
+def get_highest_harmonic(table:np.ndarray) -> int:
+    spectrum = np.abs(np.fft.rfft(table))
+    return int(np.nonzero(spectrum > spectrum[1] * FLOOR)[0][-1])
+
+def get_frequency(pitch:float) -> float:
+    return 440.0 * 2 ** ((pitch - 69) / 12)
+
+@pytest.mark.parametrize("shape", (wavetable.Shape.SAW, wavetable.Shape.SQUARE, wavetable.Shape.TRIANGLE))
+def test_no_harmonics_above_nyquist(shape):
+    table = wavetable.Wavetable(shape, SAMPLE_RATE)
+    for pitch in range(128):
+        harmonic = get_highest_harmonic(table.get(pitch))
+        assert harmonic * get_frequency(pitch) <= SAMPLE_RATE / 2, pitch
+
+def test_low_octaves_keep_harmonics():
+    table = wavetable.Wavetable(wavetable.Shape.SAW, SAMPLE_RATE)
+    assert get_highest_harmonic(table.get(36)) == wavetable.SIZE // 2 - 1
+
+@pytest.mark.parametrize("coarse_tune,fine_tune,bend_amount", ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0), (2.0, 0.0, 0.5)))
+def test_transposed_oscillator_selects_higher_table(coarse_tune, fine_tune, bend_amount):
+    table = wavetable.Wavetable(wavetable.Shape.SAW, SAMPLE_RATE)
+    notenum = 71 # Top of an octave so that any upward tuning crosses into the next table
+    pitch = wavetable.get_pitch(notenum, coarse_tune, fine_tune, bend_amount)
+    assert pitch > notenum
+
+    # The table of the untransposed note aliases at the pitch actually played
+    assert get_highest_harmonic(table.get(notenum)) * get_frequency(pitch) > SAMPLE_RATE / 2
+    assert get_highest_harmonic(table.get(pitch)) * get_frequency(min(pitch, 127)) <= SAMPLE_RATE / 2
+
+def test_downward_bend_is_ignored():
+    assert wavetable.get_pitch(60, bend_amount=-1.0) == 60
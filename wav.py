@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Reading and writing of WAV file headers
+
+import struct
+
+try:
+    import ulab.numpy as np
+except ImportError:
+    import numpy as np
+
+FORMAT_PCM = 1
+FORMAT_MULAW = 7
+FORMAT_IMA_ADPCM = 0x11
+
+def read_header(file:object) -> tuple:
+    """Parse the RIFF header of a WAV file and leave the file positioned at the start of its sample
+    data. Returns the format, channels, sample rate, bits per sample, block alignment, data offset and
+    data length in bytes.
+    """
+    header = file.read(12)
+    if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+        raise ValueError("Invalid WAV file")
+    fmt = None
+    while True:
+        chunk = file.read(8)
+        if len(chunk) < 8:
+            raise ValueError("Missing data chunk")
+        size = struct.unpack('<I', chunk[4:8])[0]
+        if chunk[0:4] == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', file.read(16))
+            file.seek(size - 16 + (size & 1), 1)
+        elif chunk[0:4] == b'data':
+            if fmt is None:
+                raise ValueError("Missing format chunk")
+            return fmt[0], fmt[1], fmt[2], fmt[5], fmt[4], file.tell(), size
+        else:
+            file.seek(size + (size & 1), 1)
+
+def read_sampler(file:object) -> tuple:
+    """Find the root note and first loop of the `smpl` chunk of a WAV file. Returns the root note and
+    loop start and end indices, each of which are `None` if not present.
+    """
+    file.seek(12)
+    while len(chunk := file.read(8)) == 8:
+        size = struct.unpack('<I', chunk[4:8])[0]
+        if chunk[0:4] == b'smpl' and size >= 36:
+            data = file.read(size)
+            root, loops = struct.unpack_from('<I', data, 12)[0], struct.unpack_from('<I', data, 28)[0]
+            loop = struct.unpack_from('<II', data, 44) if loops and size >= 60 else None
+            return root, loop
+        file.seek(size + (size & 1), 1)
+    return None, None
+
+def write(path:str, data:np.ndarray, sample_rate:int, loop:tuple = None, root:int = 60) -> None:
+    """Write a mono float array as a 16-bit PCM WAV file with an optional `smpl` chunk describing
+    the root note and loop points.
+    """
+    pcm = np.array(data, dtype=np.int16)
+    size = len(pcm) * 2
+    chunks = 4 + (8 + 16) + (8 + size)
+    if loop is not None:
+        chunks += 8 + 60
+    with open(path, "wb") as file:
+        file.write(b'RIFF' + struct.pack('<I', chunks) + b'WAVE')
+        file.write(b'fmt ' + struct.pack('<IHHIIHH', 16, FORMAT_PCM, 1, sample_rate, sample_rate * 2, 2, 16))
+        file.write(b'data' + struct.pack('<I', size))
+        file.write(pcm.tobytes())
+        if loop is not None:
+            file.write(b'smpl' + struct.pack('<IIIIIIIIII', 60, 0, 0, 1000000000 // sample_rate, root, 0, 0, 0, 1, 0))
+            file.write(struct.pack('<IIIIII', 0, 0, loop[0], loop[1], 0, 0))
+
+def write_format(path:str, fmt:int, channels:int, sample_rate:int, bits:int, block_align:int, data:bytes, frames:int, block_samples:int = 1) -> None:
+    """Write encoded sample data as a WAV file. Formats other than PCM include a `fact` chunk with the
+    number of frames, and ADPCM formats include the number of frames within each block.
+    """
+    extra = b''
+    if fmt != FORMAT_PCM:
+        extra = struct.pack('<H', 2) + struct.pack('<H', block_samples) if fmt == FORMAT_IMA_ADPCM else struct.pack('<H', 0)
+    chunks = 4 + (8 + 16 + len(extra)) + (8 + len(data) + (len(data) & 1))
+    if fmt != FORMAT_PCM:
+        chunks += 8 + 4
+    with open(path, "wb") as file:
+        file.write(b'RIFF' + struct.pack('<I', chunks) + b'WAVE')
+        file.write(b'fmt ' + struct.pack('<IHHIIHH', 16 + len(extra), fmt, channels, sample_rate, sample_rate * block_align // block_samples, block_align, bits) + extra)
+        if fmt != FORMAT_PCM:
+            file.write(b'fact' + struct.pack('<II', 4, frames))
+        file.write(b'data' + struct.pack('<I', len(data)))
+        file.write(data)
+        if len(data) & 1:
+            file.write(b'\x00')
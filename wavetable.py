@@ -0,0 +1,96 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Cooper Dalrymple
+#
+# SPDX-License-Identifier: Unlicense
+
+# Band-limited wavetables with one table per octave to prevent aliasing in upper registers
+
+import math
+
+try:
+    from micropython import const
+except ImportError:
+    const = lambda value: value
+
+try:
+    import ulab.numpy as np
+except ImportError:
+    import numpy as np
+
+SIZE = 256
+AMPLITUDE = 32767
+OCTAVES = 11 # Covers midi notes 0-127
+
+class Shape:
+    SAW = const(0)
+    SQUARE = const(1)
+    TRIANGLE = const(2)
+
+def _frequency(notenum:int) -> float:
+    return 440.0 * math.pow(2.0, (notenum - 69) / 12)
+
+def get_pitch(notenum:int, coarse_tune:float = 0.0, fine_tune:float = 0.0, bend_amount:float = 0.0) -> float:
+    """Get the highest pitch (midi note) an oscillator can reach while playing a note. Coarse tune and
+    bend range of synthvoice oscillators are in octaves and fine tune is in semitones. Only upward
+    bends can cause aliasing.
+    """
+    return notenum + coarse_tune * 12 + fine_tune + max(bend_amount, 0.0) * 12
+
+def _harmonics(shape:int, count:int) -> tuple:
+    # Fourier series coefficients as (harmonic, amplitude) pairs
+    if shape == Shape.SAW:
+        return tuple([(k, 1.0 / k) for k in range(1, count + 1)])
+    elif shape == Shape.SQUARE:
+        return tuple([(k, 1.0 / k) for k in range(1, count + 1, 2)])
+    elif shape == Shape.TRIANGLE:
+        return tuple([(k, (1.0 if (k // 2) % 2 == 0 else -1.0) / (k * k)) for k in range(1, count + 1, 2)])
+    return ((1, 1.0),)
+
+class Wavetable:
+    """A set of band-limited single-cycle waveforms, one per octave. Tables are generated on first
+    use and cached for the lifetime of the object.
+    """
+
+    def __init__(self, shape:int, sample_rate:int, size:int = SIZE, amplitude:float = 1.0):
+        self._shape = shape
+        self._sample_rate = sample_rate
+        self._size = size
+        self._amplitude = amplitude
+        self._tables = [None] * OCTAVES
+        self._phase = np.linspace(0, 2 * math.pi, size, endpoint=False)
+
+    @property
+    def shape(self) -> int:
+        return self._shape
+
+    def harmonics(self, octave:int) -> int:
+        # Limit harmonics by the highest note within the octave so that none exceed nyquist
+        frequency = _frequency(min((octave + 1) * 12 - 1, 127))
+        return max(1, min(int(self._sample_rate / 2 / frequency), self._size // 2 - 1))
+
+    def _generate(self, octave:int) -> np.ndarray:
+        data = np.zeros(self._size)
+        for k, level in _harmonics(self._shape, self.harmonics(octave)):
+            data += np.sin(self._phase * k) * level
+        peak = np.max(abs(data))
+        if peak > 0:
+            data = data * (AMPLITUDE * self._amplitude / peak)
+        return np.array(data, dtype=np.int16)
+
+    def get(self, pitch:float) -> np.ndarray:
+        """Get the table of the octave of a pitch (midi note, may be fractional), see :func:`get_pitch`."""
+        octave = min(max(int(pitch // 12), 0), OCTAVES - 1)
+        if self._tables[octave] is None:
+            self._tables[octave] = self._generate(octave)
+        return self._tables[octave]
+
+    def generate(self) -> None:
+        for octave in range(OCTAVES):
+            self.get(octave * 12)
+
+_wavetables = {}
+
+def get(shape:int, sample_rate:int) -> Wavetable:
+    """Get the shared wavetable set for a shape so that multiple oscillators reuse the same tables."""
+    if (shape, sample_rate) not in _wavetables:
+        _wavetables[(shape, sample_rate)] = Wavetable(shape, sample_rate)
+    return _wavetables[(shape, sample_rate)]